@@ -1,25 +1,64 @@
-import json
+import time
+# the startup profile counts everything this module loads
+module_loading = time.time()
+
 import sys
 import os
-import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone, timedelta
 from gzip import GzipFile
 from io import BytesIO
 from time import sleep
 
-import boto3
-
 from lib.ctgrazer.ConfigUtil import ConfigUtil
 from lib.ctgrazer.SendMessage import SendMessage
+from lib.ctgrazer.RecordStream import RecordStream, RecordStreamError
+from lib.ctgrazer.EventTime import EventTime
+from lib.ctgrazer.JsonCodec import JsonCodec
+from lib.ctgrazer.ObjectDeleter import ObjectDeleter
+from lib.ctgrazer.SweepPlanner import SweepPlanner
+from lib.ctgrazer.SweepCursor import SweepCursor
+from lib.ctgrazer.Startup import Startup
+from lib.ctgrazer.ObjectScheduler import ObjectScheduler
+from lib.ctgrazer.Checkpoint import Checkpoint
+from lib.ctgrazer.RecordFilter import RecordFilter, RecordFilterError
+from lib.ctgrazer.FieldProjector import FieldProjector
+from lib.ctgrazer.EventDedup import EventDedup
 from lib.ctgrazer.Constants import Constants, Level, ThreadLevel, EventMeta
 
 
 class ConfigValidationError(Exception): pass
 
+# raised by an object worker when the lambda should be restarted so the object is retried
+class ObjectRetryError(Exception): pass
+
 cfg = None
 MASTER_CONFIGURATION_FILE = "config.ini"
 
+# kept between invocations of a warm container: the validated config with the mtime of the
+# file it came from, and one S3 client (clients, unlike resources, are thread safe)
+config_cache = None
+config_mtime = None
+s3_client = None
+
+# the record filter compiled from the rules of the config it came from
+record_filter = None
+record_filter_rules = None
+
+# the field projector made from the field settings of the config it came from
+field_projector = None
+field_projector_settings = None
+
+# the eventIDs confirmed by HEC, shared by all invocations of the container
+event_dedup = None
+event_dedup_settings = None
+
+# when this module was loaded, and how many invocations the container has served
+container_loaded = time.time()
+invocation_count = 0
+Startup.record('Module', module_loading)
+
 
 def initialize():
     print("[INFO] Initializing ctgrazer...")
@@ -88,6 +127,12 @@ def initialize():
     # Complete Initialization
     config.complete_init()
 
+    try:
+        RecordFilter(config.get_config_value(ConfigUtil.KEY_RECORD_FILTER))
+    except RecordFilterError as error:
+        print("[ERROR] Invalid {}: {}".format(ConfigUtil.KEY_RECORD_FILTER, error))
+        config.set_valid_status(False)
+
     if not config.is_valid():
         print("[INFO] ctgrazer initialization incomplete.")
         return None
@@ -97,20 +142,176 @@ def initialize():
     return config
 
 
-def processObject(bucket, objectKey, sourcename, Logger):
+def get_config():
+    # reuse the config of an earlier invocation unless the file has changed since
+    global config_cache, config_mtime
+
+    try:
+        mtime = os.path.getmtime(MASTER_CONFIGURATION_FILE)
+    except OSError:
+        mtime = None
+
+    if config_cache is None or mtime is None or mtime != config_mtime:
+        started = time.time()
+        config_cache = initialize()
+        config_mtime = mtime
+        Startup.record('Config', started)
+
+    return config_cache
+
+
+def get_s3_client():
+    global s3_client
+
+    if s3_client is None:
+        # boto3 is loaded on first use, a misconfigured function never pays for it
+        boto3 = Startup.load('boto3')
+        started = time.time()
+        s3_client = boto3.client(Constants.AWS_S3)
+        Startup.record('S3Client', started)
+
+    return s3_client
+
+
+def get_checkpoint():
+    if not cfg.get_config_value(ConfigUtil.KEY_CHECKPOINT):
+        return None
+    return Checkpoint(cfg.get_config_value(ConfigUtil.KEY_CHECKPOINT), get_s3_client())
+
+
+def get_record_filter():
+    # compile the rules once, and again only when the config brings different ones
+    global record_filter, record_filter_rules
+
+    rules = cfg.get_config_value(ConfigUtil.KEY_RECORD_FILTER)
+    if rules != record_filter_rules:
+        record_filter = RecordFilter(rules) if rules else None
+        record_filter_rules = rules
+
+    return record_filter
+
+
+def get_field_projector():
+    global field_projector, field_projector_settings
+
+    settings = (cfg.get_config_value(ConfigUtil.KEY_FIELD_ALLOWLIST),
+                cfg.get_config_value(ConfigUtil.KEY_FIELD_DENYLIST),
+                cfg.get_config_value(ConfigUtil.KEY_FIELD_MAX_BYTES))
+    if settings != field_projector_settings:
+        field_projector = FieldProjector(*settings) if any(settings) else None
+        field_projector_settings = settings
+
+    return field_projector
+
+
+def get_event_dedup():
+    global event_dedup, event_dedup_settings
+
+    if not cfg.get_config_value(ConfigUtil.KEY_DEDUP):
+        return None
+
+    settings = (cfg.get_config_value(ConfigUtil.KEY_DEDUP_CAPACITY),
+                cfg.get_config_value(ConfigUtil.KEY_DEDUP_ERROR_RATE),
+                cfg.get_config_value(ConfigUtil.KEY_DEDUP_WINDOW) / 1000.0,
+                cfg.get_config_value(ConfigUtil.KEY_DEDUP_STORE))
+    if settings != event_dedup_settings:
+        event_dedup = EventDedup(*settings, client=get_s3_client() if settings[3] else None)
+        event_dedup.load()
+        event_dedup_settings = settings
+
+    return event_dedup
+
+
+def is_duplicate(Dedup, record, raw, count, event_ids, decoded=None):
+    # a new eventID is kept with its record number, to be remembered once HEC confirms the record
+    event_id = RecordStream.eventId(record, decoded) if raw else record.get(Constants.AWS_EVENT_ID)
+    if event_id is None:
+        return False
+    if Dedup.seen(event_id):
+        return True
+    event_ids.append((count, event_id))
+    return False
+
+
+def remember_confirmed(Dedup, event_ids, sourcename, Logger):
+    # the records of an unfinished object HEC did confirm won't be sent again
+    if Dedup is None:
+        return
+    confirmed = Logger.confirmedRecords(sourcename)
+    Dedup.add([event_id for record, event_id in event_ids if record <= confirmed])
+
+
+def save_checkpoint(checkpoint, bucket, objectKey, sourcename, saved, Logger):
+    # store how many records HEC has confirmed, if more than 'saved'; returns the number stored now
+    if checkpoint is None:
+        return saved
+
+    confirmed = Logger.confirmedRecords(sourcename)
+    if confirmed <= saved:
+        return saved
+
+    try:
+        checkpoint.put(bucket, objectKey, confirmed)
+    except Exception as error:
+        Logger.sendEvent('Unable to Save Checkpoint Obj:' + objectKey + ' Reason:' + str(error), severity=Level.WARNING)
+        return saved
+
+    return confirmed
+
+
+def settle_spilled(spilled, obj_list, Logger, Deleter):
+    # after a replay, remove each object whose records are all confirmed now, and move the
+    # checkpoint of the others over the records confirmed; an object with batches on disk again
+    # is left alone until a later replay. Returns obj_list without the objects dealt with here
+    checkpoint = get_checkpoint()
+    Dedup = get_event_dedup()
+    settled = set()
+
+    for sourcename, spilled_object in spilled.items():
+        bucket, _, objectKey = sourcename[len('s3://'):].partition('/')
+        if Dedup is not None:
+            Dedup.add(spilled_object.confirmedIds())
+
+        start = checkpoint.get(bucket, objectKey) if checkpoint is not None else 0
+        if spilled_object.complete(start):
+            if checkpoint is not None and start:
+                try:
+                    checkpoint.clear(bucket, objectKey)
+                except Exception as error:
+                    Logger.sendEvent('Unable to Clear Checkpoint Obj:' + objectKey + ' Reason:' + str(error), severity=Level.WARNING)
+            Logger.sendEvent('Finished From Spill Obj:' + sourcename)
+            Deleter.add(bucket, objectKey)
+            settled.add((bucket, objectKey))
+            continue
+
+        confirmed = spilled_object.leading(start)
+        if checkpoint is not None and confirmed > start:
+            try:
+                checkpoint.put(bucket, objectKey, confirmed)
+            except Exception as error:
+                Logger.sendEvent('Unable to Save Checkpoint Obj:' + objectKey + ' Reason:' + str(error), severity=Level.WARNING)
+        if spilled_object.pending:
+            Logger.sendEvent('Spilled Batches Left, Deferred Obj:' + sourcename, severity=Level.WARNING)
+            settled.add((bucket, objectKey))
+
+    return [obj for obj in obj_list if (obj[0], obj[1]) not in settled]
+
+
+def processObject(bucket, objectKey, sourcename, Logger, Deleter):
     retries = 3
     count = 0
+    started = time.time()
 
     Logger.sendEvent('Processing Obj: ' + sourcename)
 
-    s3 = boto3.resource(Constants.AWS_S3)
-    object = s3.Object(bucket, objectKey)
+    # the client is shared by all object workers
+    s3 = get_s3_client()
 
     # in case the object key isn't there yet; sleep a little and check again
     # sometimes the notification beats the object
     for attempt in range(retries + 1):
         try:
-            response = object.get()
+            response = s3.get_object(Bucket=bucket, Key=objectKey)
         except:
             if attempt < (retries):
                 sleep(10)
@@ -118,65 +319,255 @@ def processObject(bucket, objectKey, sourcename, Logger):
                 continue
             else:
                 Logger.sendEvent('Retries:' + str(retries) + ' exhausted.  Can\'t Get Object:' + objectKey + ' From BUCKET:' + bucket, severity=Level.CRITICAL)
-                # finish all writes to the log, and force a lambda restart by sending
-                # non-zero return code
-                Logger.kill()
-                sys.exit(0)
+                # the worker pool finishes all writes to the log, and forces a lambda
+                # restart by sending non-zero return code
+                raise ObjectRetryError('Can\'t Get Object:' + objectKey)
         else:
             # we got the object, move forward
             break
 
-    # Sometimes the stream times out, may be the object hasn't fully copied, if so retry
-    retries = 3
-    for attempt in range(retries + 1):
-        try:
-            data = BytesIO(response['Body'].read())
-        except:
-            if attempt < retries:
-                Logger.sendEvent('Attempt to Stream Data Failed, Attempt Number:' + str(attempt + 1), severity=Level.WARNING)
-                # we will retry so need to re-get the object
-                sleep(5)
-                try:
-                    response = object.get()
-                except:
-                    Logger.sendEvent('Can\'t Get Object Stream Attempt, Obj: ' + objectKey + ' From BUCKET:' + bucket, severity=Level.CRITICAL)
-                    Logger.kill()
-                    sys.exit(0)
+    raw_passthrough = cfg.get_config_value(ConfigUtil.KEY_RAW_PASSTHROUGH)
+    source_type = cfg.get_config_value(ConfigUtil.KEY_SOURCE_TYPE)
+    epochs = None
+
+    # skip the records an earlier attempt got confirmed by HEC
+    checkpoint = get_checkpoint()
+    skip = checkpoint.get(bucket, objectKey) if checkpoint is not None else 0
+    saved = skip
+    saved_at = time.time()
+    checkpoint_interval = cfg.get_config_value(ConfigUtil.KEY_CHECKPOINT_INTERVAL) / 1000.0
+    Logger.startSource(sourcename, skip)
+
+    # records the filter drops are never serialized or batched
+    Filter = get_record_filter()
+    filter_hits = Filter.counters() if Filter is not None else None
+    dropped = 0
+
+    # projected records are encoded once, after the fields are cut down
+    Projector = get_field_projector()
+    bytes_saved = 0
+
+    # records already confirmed by an earlier invocation are dropped
+    Dedup = get_event_dedup()
+    event_ids = []
+    duplicates = 0
+    if skip:
+        Logger.sendEvent('Resuming Obj: ' + sourcename + ' After Records:' + str(skip))
+
+    if cfg.get_config_value(ConfigUtil.KEY_STREAM_RECORDS):
+        # decompress and parse the body as it is read, so only one record is held at a time
+        data = response['Body']
+    else:
+        # Sometimes the stream times out, may be the object hasn't fully copied, if so retry
+        retries = 3
+        for attempt in range(retries + 1):
+            try:
+                data = BytesIO(response['Body'].read())
+            except:
+                if attempt < retries:
+                    Logger.sendEvent('Attempt to Stream Data Failed, Attempt Number:' + str(attempt + 1), severity=Level.WARNING)
+                    # we will retry so need to re-get the object
+                    sleep(5)
+                    try:
+                        response = s3.get_object(Bucket=bucket, Key=objectKey)
+                    except:
+                        Logger.sendEvent('Can\'t Get Object Stream Attempt, Obj: ' + objectKey + ' From BUCKET:' + bucket, severity=Level.CRITICAL)
+                        raise ObjectRetryError('Can\'t Get Object Stream Attempt, Obj: ' + objectKey)
+                else:
+                    Logger.sendEvent('Retries:' + str(retries) + ' exhausted.  Can\'t Stream Obj: ' + objectKey + ' From BUCKET:' + bucket, severity=Level.CRITICAL)
+                    # we did our best, 3 strikes and your out.
+                    # cause a invocation error and retry
+                    raise ObjectRetryError('Can\'t Stream Obj: ' + objectKey)
             else:
-                Logger.sendEvent('Retries:' + str(retries) + ' exhausted.  Can\'t Stream Obj: ' + objectKey + ' From BUCKET:' + bucket, severity=Level.CRITICAL)
-                # we did our best, 3 strikes and your out.
-                # cause a invocation error and retry
-                Logger.kill()
-                sys.exit(0)
-        else:
-            break
-    dcfile = json.loads(GzipFile(fileobj=data, mode='rb').read().decode(Constants.ENCODING_UTF))
-
-    for record in dcfile[Constants.AWS_RECORDS]:
-        count += 1
-        payload = {}
-        payload.update({EventMeta.SOURCE_TYPE.value: cfg.get_config_value(ConfigUtil.KEY_SOURCE_TYPE)})
-        payload.update({EventMeta.SOURCE.value: sourcename})
-        payload.update({EventMeta.TIME.value: time.mktime(datetime.strptime(record[Constants.AWS_EVENT_TIME], Constants.TIME_STAMP_YMDHMZ).timetuple())})
-        payload.update({EventMeta.EVENT.value: record})
-        Logger.batchEvent(payload)
-
-        if Logger.isError():
-            # in case the error is with HEC, print to CloudWatch as well
-            print('Error Reason:' + Logger.errorMessage)
-            Logger.sendEvent('Error Reason:' + Logger.errorMessage, severity=Level.ERROR)
-            return
-
-    # log the number of CT events in the object
-    Logger.sendEvent('Events processed: ' + str(count))
-
-    # remove the object if load was fine
-    try:
-        object.delete()
-    except:
-        Logger.sendEvent('Unable to Remove Obj:' + sourcename, severity=Level.ERROR)
+                break
+
+    # with a projector, streamed records are only parsed when they have fields to cut
+    as_spans = raw_passthrough or (Projector is not None and cfg.get_config_value(ConfigUtil.KEY_STREAM_RECORDS))
+    if as_spans:
+        # hand out each record's original bytes, they go into the HEC envelope untouched
+        # unless the projector has something to cut
+        records = RecordStream(data).spans()
+    elif cfg.get_config_value(ConfigUtil.KEY_STREAM_RECORDS):
+        records = RecordStream(data).records()
     else:
-        Logger.sendEvent('Removed Obj: ' + sourcename)
+        dcfile = JsonCodec.loads(GzipFile(fileobj=data, mode='rb').read())
+        records = dcfile[Constants.AWS_RECORDS]
+        # the whole object is in memory, so convert all of its timestamps in one pass
+        epochs = EventTime.toEpochBatch([record[Constants.AWS_EVENT_TIME] for record in records[skip:]])
+
+    # a raw record is parsed at most once, when the filter, dedup or the projector needs its fields
+    parse_checks = []
+    if as_spans:
+        if Filter is not None:
+            parse_checks.append(Filter.needsParse)
+        if Dedup is not None:
+            parse_checks.append(RecordStream.hasEventId)
+        if Projector is not None:
+            parse_checks.append(Projector.needsParse)
+
+    try:
+        for record in records:
+            count += 1
+            if count <= skip:
+                continue
+            decoded = None
+            if parse_checks and any(check(record) for check in parse_checks):
+                decoded = JsonCodec.loads(record)
+            if Filter is not None and not (Filter.keepRaw(record, filter_hits, decoded) if as_spans
+                                           else Filter.keep(record, filter_hits)):
+                dropped += 1
+            elif Dedup is not None and is_duplicate(Dedup, record, as_spans, count, event_ids, decoded):
+                duplicates += 1
+            elif Projector is not None:
+                if as_spans:
+                    event_time = RecordStream.eventTime(record)
+                    event_time = EventTime.toEpoch(event_time) if event_time else None
+                    event, cut = Projector.projectRaw(record, decoded)
+                else:
+                    if epochs is not None:
+                        event_time = epochs[count - 1 - skip]
+                    else:
+                        event_time = EventTime.toEpoch(record[Constants.AWS_EVENT_TIME])
+                    event, cut = Projector.project(record)
+                bytes_saved += cut
+                Logger.batchRawEvent(source_type, sourcename, event_time, event, record=count)
+            elif raw_passthrough:
+                event_time = RecordStream.eventTime(record)
+                Logger.batchRawEvent(source_type,
+                                     sourcename,
+                                     EventTime.toEpoch(event_time) if event_time else None,
+                                     record,
+                                     record=count
+                                    )
+            else:
+                if epochs is not None:
+                    event_time = epochs[count - 1 - skip]
+                else:
+                    event_time = EventTime.toEpoch(record[Constants.AWS_EVENT_TIME])
+                payload = {}
+                payload.update({EventMeta.SOURCE_TYPE.value: source_type})
+                payload.update({EventMeta.SOURCE.value: sourcename})
+                payload.update({EventMeta.TIME.value: event_time})
+                payload.update({EventMeta.EVENT.value: record})
+                Logger.batchEvent(payload, record=count)
+
+            if checkpoint is not None and count % Constants.CHECKPOINT_CHECK_RECORDS == 0 and \
+                    time.time() - saved_at >= checkpoint_interval:
+                saved = save_checkpoint(checkpoint, bucket, objectKey, sourcename, saved, Logger)
+                saved_at = time.time()
+
+            if Logger.isError():
+                # in case the error is with HEC, print to CloudWatch as well
+                print('Error Reason:' + Logger.errorMessage)
+                Logger.sendEvent('Error Reason:' + Logger.errorMessage, severity=Level.ERROR)
+                remember_confirmed(Dedup, event_ids, sourcename, Logger)
+                Logger.noteSource(sourcename, None, event_ids)
+                save_checkpoint(checkpoint, bucket, objectKey, sourcename, saved, Logger)
+                return
+    except RecordStreamError as error:
+        # the stream broke part way through; records already batched will be sent again on retry,
+        # unless they are confirmed by now and covered by the checkpoint
+        remember_confirmed(Dedup, event_ids, sourcename, Logger)
+        Logger.noteSource(sourcename, None, event_ids)
+        save_checkpoint(checkpoint, bucket, objectKey, sourcename, saved, Logger)
+        Logger.sendEvent('Can\'t Stream Obj: ' + objectKey + ' From BUCKET:' + bucket + ' Reason:' + str(error) + ' After Records:' + str(count), severity=Level.CRITICAL)
+        raise ObjectRetryError('Can\'t Stream Obj: ' + objectKey)
+
+    # log the number of CT events in the object, and how long the object took
+    message = 'Events processed: ' + str(count) + ' Object_ms=' + str(int((time.time() - started) * 1000))
+    if Filter is not None:
+        message += ' Dropped=' + str(dropped) + ' ' + ' '.join(Filter.getFields(filter_hits))
+    if Projector is not None:
+        message += ' Bytes_saved=' + str(bytes_saved)
+    if Dedup is not None:
+        message += ' Duplicates=' + str(duplicates)
+    Logger.sendEvent(message)
+
+    # the object may only go once HEC has confirmed every batch holding its events
+    if not Logger.waitForSource(sourcename):
+        remember_confirmed(Dedup, event_ids, sourcename, Logger)
+        # with some of its batches spilled, the replay finishes the object off
+        Logger.noteSource(sourcename, count, event_ids)
+        Logger.sendEvent('Not All Events Confirmed, Keeping Obj:' + sourcename, severity=Level.ERROR)
+        save_checkpoint(checkpoint, bucket, objectKey, sourcename, saved, Logger)
+        return
+
+    if Dedup is not None:
+        Dedup.add([event_id for record, event_id in event_ids])
+
+    if checkpoint is not None and saved:
+        # should the delete below fail, the object is sent again from its first record
+        try:
+            checkpoint.clear(bucket, objectKey)
+        except Exception as error:
+            Logger.sendEvent('Unable to Clear Checkpoint Obj:' + objectKey + ' Reason:' + str(error), severity=Level.WARNING)
+
+    # remove the object if load was fine, batched with the other processed objects
+    Deleter.add(bucket, objectKey)
+
+
+def processWorker(bucket, objectKey, Logger, Deleter):
+    sourcename = 's3://' + bucket + '/' + objectKey
+
+    # once HEC has failed, don't start on any more objects
+    if Logger.isError():
+        return
+
+    processObject(bucket,
+                  objectKey,
+                  sourcename,
+                  Logger,
+                  Deleter
+                 )
+
+    if Logger.isError():
+        print('Not Fully Processed Obj:' + sourcename + ' Reason:' + Logger.errorMessage)
+        Logger.sendEvent('Not Fully Processed Obj:' + sourcename + ' Reason:' + Logger.errorMessage, severity=Level.CRITICAL)
+
+
+def scheduledWorker(Scheduler, Logger, Deleter):
+    # keep taking objects until the scheduler runs out of them or of time.
+    # Returns the objects that need a retry.
+    retry_list = []
+
+    obj = Scheduler.next()
+    while obj is not None:
+        bucket, key = obj[0], obj[1]
+        started = time.time()
+        try:
+            processWorker(bucket, key, Logger, Deleter)
+        except ObjectRetryError as error:
+            retry_list.append((bucket, key))
+            print('Object Needs Retry: ' + str(error))
+        Scheduler.done(obj, time.time() - started)
+        obj = Scheduler.next()
+
+    return retry_list
+
+
+def processObjects(obj_list, Logger, Deleter, context):
+    # run a bounded pool of object workers, each doing its own GET, decompression and parsing,
+    # all of them feeding the shared batcher. obj_list holds (bucket, key, size, modified) tuples.
+    # Returns the objects that need a retry.
+    worker_size = max(1, min(cfg.get_config_value(ConfigUtil.KEY_OBJECT_WORKER_SIZE), len(obj_list)))
+    retry_list = []
+
+    # oldest objects first, and none started that can't finish before the lambda times out
+    scheduler = ObjectScheduler(obj_list,
+                                context.get_remaining_time_in_millis,
+                                cfg.get_config_value(ConfigUtil.KEY_SCHEDULER_SAFETY_MARGIN))
+
+    with ThreadPoolExecutor(max_workers=worker_size) as pool:
+        futures = [pool.submit(scheduledWorker, scheduler, Logger, Deleter) for x in range(worker_size)]
+
+        for future in as_completed(futures):
+            retry_list.extend(future.result())
+
+    for obj in scheduler.deferred:
+        Logger.sendEvent('Out Of Time, Deferred Obj: s3://' + obj[0] + '/' + obj[1], severity=Level.WARNING)
+    Logger.sendEvent('Scheduler: ' + ' '.join(scheduler.getFields()))
+
+    return retry_list
 
 
 def determine_thread_size(size):
@@ -195,49 +586,113 @@ def determine_thread_size(size):
     return number_of_threads
 
 
+def get_notified_objects(records):
+    # returns (bucket, key, size) for each object in the records of an S3 notification
+    objects = []
+    for record in records:
+        bucket = record[Constants.AWS_S3][Constants.AWS_BUCKET][Constants.AWS_NAME]
+        key = urllib.parse.unquote_plus(record[Constants.AWS_S3][Constants.AWS_OBJECT][Constants.AWS_KEY], encoding=Constants.ENCODING_UTF)
+        objects.append((bucket, key, record[Constants.AWS_S3][Constants.AWS_OBJECT][Constants.AWS_SIZE]))
+    return objects
+
+
+def get_queued_objects(message):
+    # returns the objects an SQS message announces; the body is an S3 notification, sent
+    # straight to the queue or wrapped by SNS. Test events and other messages hold no objects.
+    body = JsonCodec.loads(message[Constants.AWS_SQS_BODY])
+    if Constants.AWS_SNS_MESSAGE in body:
+        body = JsonCodec.loads(body[Constants.AWS_SNS_MESSAGE])
+    records = [record for record in body.get(Constants.AWS_RECORDS, [])
+               if record.get(Constants.AWS_EVENT_SRC) == Constants.AWS_EVENT_SRC_S3]
+    return get_notified_objects(records)
+
+
 def lambda_handler(event, context):
 
-    # Initialize ctgrazer configuration
-    global cfg
-    cfg = initialize()
+    global cfg, invocation_count
+    invoked = time.time()
+    cold = invocation_count == 0
+    invocation_count += 1
+
+    # Initialize ctgrazer configuration, a warm container keeps it from the last invocation
+    cfg = get_config()
+    config_ms = int((time.time() - invoked) * 1000)
 
     if not cfg or not cfg.is_valid():
         raise ConfigValidationError('Please handle config error.')
 
     obj_list = []
+    planner = None
+    cursor = None
+    # SQS message id -> the objects it announced, None when it couldn't be read
+    messages = None
 
-    if Constants.AWS_RECORDS in event.keys() and event[Constants.AWS_RECORDS][0][Constants.AWS_EVENT_SRC] == 'aws:s3':
+    if Constants.AWS_RECORDS in event.keys() and event[Constants.AWS_RECORDS][0][Constants.AWS_EVENT_SRC] == Constants.AWS_EVENT_SRC_S3:
 
-        bucket = event[Constants.AWS_RECORDS][0][Constants.AWS_S3][Constants.AWS_BUCKET][Constants.AWS_NAME]
         called_method = Constants.GRAZER_EVENT_S3_PUT
+        size = 0
 
-        obj_list.append(urllib.parse.unquote_plus(event[Constants.AWS_RECORDS][0][Constants.AWS_S3][Constants.AWS_OBJECT][Constants.AWS_KEY], encoding=Constants.ENCODING_UTF))
-        size = event[Constants.AWS_RECORDS][0][Constants.AWS_S3][Constants.AWS_OBJECT][Constants.AWS_SIZE]
+        # a notification can carry more than one object, process all of them
+        for bucket, key, object_size in get_notified_objects(event[Constants.AWS_RECORDS]):
+            # objects of one notification are all new, keep them in the order they came in
+            obj_list.append((bucket, key, object_size, 0))
+            size += object_size
 
+        # Set thread size based on the file size for s3 put trigger
         number_of_threads = determine_thread_size(size)
 
-        # Set thread size based on the file size for s3 put trigger
-        cfg.config[ConfigUtil.KEY_BATCH_THREAD_SIZE] = number_of_threads
+    elif Constants.AWS_RECORDS in event.keys() and event[Constants.AWS_RECORDS][0][Constants.AWS_EVENT_SRC] == Constants.AWS_EVENT_SRC_SQS:
+        # a batch of queued S3 notifications, all of their objects go through one invocation
+
+        called_method = Constants.GRAZER_EVENT_SQS
+        size = 0
+        messages = {}
+        queued = set()
+
+        for message in event[Constants.AWS_RECORDS]:
+            try:
+                objects = get_queued_objects(message)
+            except (ValueError, KeyError, TypeError) as error:
+                print('[ERROR] Unreadable SQS message {}: {}'.format(message.get(Constants.AWS_SQS_MESSAGE_ID), error))
+                messages[message[Constants.AWS_SQS_MESSAGE_ID]] = None
+                continue
+
+            messages[message[Constants.AWS_SQS_MESSAGE_ID]] = objects
+            for bucket, key, object_size in objects:
+                # S3 may announce an object more than once
+                if (bucket, key) in queued:
+                    continue
+                queued.add((bucket, key))
+                obj_list.append((bucket, key, object_size, 0))
+                size += object_size
+
+        number_of_threads = determine_thread_size(size)
 
     elif Constants.AWS_DETAIL_TYPE in event.keys() and event['source']=='aws.events':
         # this means we were called via scheduled event, so see if any old files need
         # to be retrieved
 
         called_method = event[Constants.AWS_DETAIL_TYPE]
-        s3 = boto3.resource(Constants.AWS_S3)
 
         bucket = cfg.get_config_value(ConfigUtil.KEY_S3_BUCKET)
         prefix = cfg.get_config_value(ConfigUtil.KEY_S3_BUCKET_PREFIX)
+        cutoff = datetime.now(timezone.utc) - timedelta(minutes=int(cfg.get_config_value(ConfigUtil.KEY_MINS_TO_PROCESS)))
+
+        client = get_s3_client()
 
-        bucket_instance = s3.Bucket(bucket)
-        objs = bucket_instance.objects.filter(Prefix=prefix)
+        if cfg.get_config_value(ConfigUtil.KEY_SWEEP_CURSOR):
+            cursor = SweepCursor(cfg.get_config_value(ConfigUtil.KEY_SWEEP_CURSOR),
+                                 client,
+                                 cfg.get_config_value(ConfigUtil.KEY_SWEEP_FULL_RESCAN_EVERY))
+            cursor.load()
 
-        for obj in objs:
-            object = s3.Object(bucket, obj.key)
-            difference = (datetime.now(timezone.utc) - object.last_modified) / timedelta(minutes=1)
+        # the listing already carries LastModified, no need to look at the objects themselves
+        planner = SweepPlanner(client, bucket, cfg.get_config_value(ConfigUtil.KEY_SWEEP_LIST_WORKERS), cursor)
 
-            if difference > int(cfg.get_config_value(ConfigUtil.KEY_MINS_TO_PROCESS)):
-                obj_list.append(obj.key)
+        for obj in planner.plan(prefix, cutoff):
+            if cursor is not None and cursor.isCursor(bucket, obj['Key']):
+                continue
+            obj_list.append((bucket, obj['Key'], obj['Size'], obj['LastModified'].timestamp()))
 
         # just set to default of 5
         number_of_threads = cfg.get_config_value(ConfigUtil.KEY_BATCH_THREAD_SIZE)
@@ -247,25 +702,84 @@ def lambda_handler(event, context):
         print(Constants.GRAZER_EVENT_UNHANDLED)
         sys.exit(1)
 
-    logger = SendMessage(context, cfg)
+    # build the client before the logger, so a cold start's boto3 load shows in the START record
+    get_s3_client()
+
+    logger = SendMessage(context, cfg, number_of_threads)
     # if we could not create the object, then just print to cloudWatch all objects not processed
     # based on size of object, create set the number of threads
     logger.sendEvent('Called via:' + called_method)
 
+    # cold start covers loading the module up to this invocation; a warm one only reads the cache
+    logger.sendEvent('Container Cold=' + str(cold) +
+                     ' Invocation=' + str(invocation_count) +
+                     ' ColdStart_ms=' + (str(int((invoked - container_loaded) * 1000)) if cold else '0') +
+                     ' Config_ms=' + str(config_ms))
+
     logger.sendEvent('Number of threads Requested:' + str(number_of_threads) + ' Size:' + str(size))
 
-    for key in obj_list:
-        # make call for each object
-        sourcename = 's3://' + bucket + '/' + key
-        processObject(bucket,
-                      key,
-                      sourcename,
-                      logger
-                     )
-
-        if logger.isError():
-            print('Not Fully Processed Obj:' + sourcename + ' Reason:' + logger.errorMessage)
-            logger.sendEvent('Not Fully Processed Obj:' + sourcename + ' Reason:' + logger.errorMessage, severity=Level.CRITICAL)
-            break
+    logger.sendEvent('Number of Objects:' + str(len(obj_list)))
+
+    if planner is not None:
+        fields = planner.getFields()
+        if cursor is not None:
+            fields.extend(cursor.getFields())
+        logger.sendEvent('Sweep Listing: ' + ' '.join(fields))
+
+    # processed objects are removed in bulk in the background while the rest are worked on
+    deleter = ObjectDeleter(get_s3_client(), logger)
+
+    try:
+        try:
+            # batches an earlier invocation of this container couldn't deliver go out before new
+            # work, and the objects they came from aren't read again for the records they hold
+            replayed, spilled = logger.replaySpill()
+            if replayed:
+                logger.sendEvent('Spill Replayed Batches:' + str(replayed))
+            if spilled:
+                obj_list = settle_spilled(spilled, obj_list, logger, deleter)
+
+            retry_list = processObjects(obj_list, logger, deleter, context)
+        finally:
+            # the objects HEC confirmed are removed even when a worker failed
+            deleter.close()
+    except BaseException as error:
+        # drain the log and send the STOP record before the error ends the invocation
+        logger.sendEvent('Object Worker Failed:' + str(error), severity=Level.CRITICAL)
+        logger.kill()
+        raise
+
+    dedup = get_event_dedup()
+    if dedup is not None:
+        logger.sendEvent('Dedup: ' + ' '.join(dedup.getFields()))
+        try:
+            dedup.save()
+        except Exception as error:
+            logger.sendEvent('Unable to Save Dedup Filters:' + str(error), severity=Level.WARNING)
+
+    if cursor is not None:
+        # move each region's mark over the objects that are gone now
+        processed = set(key for b, key in deleter.removedKeys if b == bucket)
+        for region, listed in planner.listed.items():
+            cursor.advance(region, listed, processed)
+        try:
+            cursor.save()
+        except Exception as error:
+            logger.sendEvent('Unable to Save Sweep Cursor:' + str(error), severity=Level.WARNING)
+
+    if messages is not None:
+        # only the messages with an object that wasn't processed and removed are delivered again;
+        # this needs ReportBatchItemFailures turned on for the event source mapping
+        failures = [message_id for message_id, objects in messages.items()
+                    if objects is None or any((b, key) not in deleter.removedKeys for b, key, object_size in objects)]
+        logger.sendEvent('SQS Messages:' + str(len(messages)) + ' Failed:' + str(len(failures)))
+        logger.kill()
+        return {Constants.AWS_BATCH_FAILURES: [{Constants.AWS_ITEM_IDENTIFIER: message_id} for message_id in failures]}
+
+    if retry_list:
+        # finish all writes to the log, and force a lambda restart by sending
+        # non-zero return code so the failed objects are tried again
+        logger.kill()
+        sys.exit(0)
 
     logger.kill()
@@ -0,0 +1,98 @@
+"""
+Description: Remembers, per S3 object, how many of its leading records HEC has confirmed,
+so an object that wasn't finished is resumed after them instead of being sent again from
+its first record. Checkpoints are kept as a tag on the object itself ('tag'), as sidecar
+objects under an S3 prefix ('s3://bucket/prefix/'), or in a local JSON file (any other value).
+"""
+
+import os
+import threading
+
+from lib.ctgrazer.Constants import Constants
+from lib.ctgrazer.JsonCodec import JsonCodec
+
+
+class Checkpoint:
+
+    TAG = 'tag'
+    S3_SCHEME = 's3://'
+
+    def __init__(self, location, client=None):
+        self.location = location
+        self.client = client
+        self.lock = threading.Lock()
+
+        if location == self.TAG:
+            self.backend = self.TAG
+        elif location.startswith(self.S3_SCHEME):
+            self.backend = self.S3_SCHEME
+            self.bucket, _, self.prefix = location[len(self.S3_SCHEME):].partition('/')
+        else:
+            self.backend = None
+
+    # Returns the number of leading records of the object already confirmed, 0 if none
+    def get(self, bucket, key):
+        try:
+            if self.backend == self.TAG:
+                value = self._getTags(bucket, key).get(Constants.CHECKPOINT_TAG)
+            elif self.backend == self.S3_SCHEME:
+                try:
+                    value = self.client.get_object(Bucket=self.bucket, Key=self._sidecarKey(bucket, key))['Body'].read()
+                except self.client.exceptions.NoSuchKey:
+                    value = None
+            else:
+                with self.lock:
+                    value = self._readFile().get(bucket + '/' + key)
+        except Exception as error:
+            # without a checkpoint the object is simply sent from the start
+            print('[WARNING] Unable to read checkpoint of {}/{}: {}'.format(bucket, key, error))
+            return 0
+        return int(value) if value else 0
+
+    def put(self, bucket, key, records):
+        if self.backend == self.TAG:
+            # tagging replaces the whole set, keep the tags the object already has
+            tags = self._getTags(bucket, key)
+            tags[Constants.CHECKPOINT_TAG] = str(records)
+            self.client.put_object_tagging(Bucket=bucket, Key=key,
+                                           Tagging={'TagSet': [{'Key': k, 'Value': v} for k, v in tags.items()]})
+        elif self.backend == self.S3_SCHEME:
+            self.client.put_object(Bucket=self.bucket, Key=self._sidecarKey(bucket, key), Body=str(records).encode())
+        else:
+            with self.lock:
+                checkpoints = self._readFile()
+                checkpoints[bucket + '/' + key] = records
+                self._writeFile(checkpoints)
+
+    # Drops the checkpoint of an object that is done; a tag goes with the object itself
+    def clear(self, bucket, key):
+        if self.backend == self.TAG:
+            return
+        elif self.backend == self.S3_SCHEME:
+            self.client.delete_object(Bucket=self.bucket, Key=self._sidecarKey(bucket, key))
+        else:
+            with self.lock:
+                checkpoints = self._readFile()
+                if checkpoints.pop(bucket + '/' + key, None) is not None:
+                    self._writeFile(checkpoints)
+
+    def _getTags(self, bucket, key):
+        response = self.client.get_object_tagging(Bucket=bucket, Key=key)
+        return {tag['Key']: tag['Value'] for tag in response.get('TagSet', [])}
+
+    def _sidecarKey(self, bucket, key):
+        return self.prefix + bucket + '/' + key
+
+    def _readFile(self):
+        if not os.path.exists(self.location):
+            return {}
+        with open(self.location, 'rb') as f:
+            data = f.read()
+        return JsonCodec.loads(data) if data else {}
+
+    def _writeFile(self, checkpoints):
+        # write aside and swap, so a checkpoint file is never left half written
+        temp = self.location + '.tmp'
+        with open(temp, 'wb') as f:
+            f.write(JsonCodec.dumpb(checkpoints))
+        os.replace(temp, self.location)
@@ -17,6 +17,51 @@ class ConfigUtil:
     KEY_LOG_DESTINATION     = 'log_destination'
     KEY_LOG_MSG_PREFIX      = 'log_message_prefix'
     KEY_DEBUG               = 'debug'
+    KEY_STREAM_RECORDS      = 'stream_records'
+    KEY_OBJECT_WORKER_SIZE  = 'object_worker_size'
+    KEY_HEC_POOL_SIZE       = 'hec_pool_size'
+    KEY_HEC_KEEP_ALIVE      = 'hec_keep_alive'
+    KEY_HEC_IDLE_TIMEOUT    = 'hec_idle_timeout'
+    KEY_HEC_GZIP            = 'hec_gzip'
+    KEY_HEC_GZIP_LEVEL      = 'hec_gzip_level'
+    KEY_RAW_PASSTHROUGH     = 'raw_passthrough'
+    KEY_FLUSH_QUEUE_MAX_BATCHES = 'flush_queue_max_batches'
+    KEY_FLUSH_QUEUE_MAX_BYTES   = 'flush_queue_max_bytes'
+    KEY_HEC_ADAPTIVE_THREADS    = 'hec_adaptive_threads'
+    KEY_HEC_MIN_THREADS         = 'hec_min_threads'
+    KEY_HEC_MAX_THREADS         = 'hec_max_threads'
+    KEY_HEC_BATCH_MAX_BYTES     = 'hec_batch_max_bytes'
+    KEY_HEC_BATCH_MAX_EVENTS    = 'hec_batch_max_events'
+    KEY_HEC_BATCH_AUTOTUNE      = 'hec_batch_autotune'
+    KEY_HEC_RETRY_ATTEMPTS      = 'hec_retry_attempts'
+    KEY_HEC_RETRY_BASE_DELAY    = 'hec_retry_base_delay'
+    KEY_HEC_RETRY_MAX_DELAY     = 'hec_retry_max_delay'
+    KEY_HEC_RETRY_RESERVE       = 'hec_retry_reserve'
+    KEY_SWEEP_LIST_WORKERS      = 'sweep_list_workers'
+    KEY_SWEEP_CURSOR            = 'sweep_cursor'
+    KEY_SWEEP_FULL_RESCAN_EVERY = 'sweep_full_rescan_every'
+    KEY_SCHEDULER_SAFETY_MARGIN = 'scheduler_safety_margin'
+    KEY_CHECKPOINT              = 'checkpoint'
+    KEY_CHECKPOINT_INTERVAL     = 'checkpoint_interval'
+    KEY_SPILL_DIR               = 'spill_dir'
+    KEY_SPILL_MAX_BYTES         = 'spill_max_bytes'
+    KEY_SPILL_SEGMENT_BYTES     = 'spill_segment_bytes'
+    KEY_HEC_USE_ACK             = 'hec_use_ack'
+    KEY_HEC_ACK_POLL_INTERVAL   = 'hec_ack_poll_interval'
+    KEY_HEC_ACK_TIMEOUT         = 'hec_ack_timeout'
+    KEY_HEC_BALANCE             = 'hec_balance'
+    KEY_HEC_HEALTH_CHECK        = 'hec_health_check'
+    KEY_HEC_EJECT_ERRORS        = 'hec_eject_errors'
+    KEY_HEC_EJECT_TIME          = 'hec_eject_time'
+    KEY_RECORD_FILTER           = 'record_filter'
+    KEY_FIELD_ALLOWLIST         = 'field_allowlist'
+    KEY_FIELD_DENYLIST          = 'field_denylist'
+    KEY_FIELD_MAX_BYTES         = 'field_max_bytes'
+    KEY_DEDUP                   = 'dedup'
+    KEY_DEDUP_CAPACITY          = 'dedup_capacity'
+    KEY_DEDUP_ERROR_RATE        = 'dedup_error_rate'
+    KEY_DEDUP_WINDOW            = 'dedup_window'
+    KEY_DEDUP_STORE             = 'dedup_store'
 
     KEY_S3_BUCKET           = 'aws_s3_bucket_name'
     KEY_SOURCE_TYPE         = 'splunk_source_type'
@@ -37,7 +82,52 @@ class ConfigUtil:
         , KEY_LOG_DESTINATION: {KEY_VALUE:'CLOUDWATCH', KEY_TYPE:'string'}
         , KEY_LOG_MSG_PREFIX: {KEY_VALUE:'Time_ms=%d RequestId=%s Severity=%s Msg:%s', KEY_TYPE:'string'}
         , KEY_DEBUG: {KEY_VALUE:False, KEY_TYPE:'boolean'}
-        , KEY_SPLUNK_DEBUG_SOURCETYPE: {KEY_VALUE:'splunk:Lambda', KEY_TYPE:'string'}}
+        , KEY_SPLUNK_DEBUG_SOURCETYPE: {KEY_VALUE:'splunk:Lambda', KEY_TYPE:'string'}
+        , KEY_STREAM_RECORDS: {KEY_VALUE:True, KEY_TYPE:'boolean'}
+        , KEY_OBJECT_WORKER_SIZE: {KEY_VALUE:4, KEY_TYPE:'int'}
+        , KEY_HEC_POOL_SIZE: {KEY_VALUE:1, KEY_TYPE:'int'}
+        , KEY_HEC_KEEP_ALIVE: {KEY_VALUE:True, KEY_TYPE:'boolean'}
+        , KEY_HEC_IDLE_TIMEOUT: {KEY_VALUE:50, KEY_TYPE:'int'}
+        , KEY_HEC_GZIP: {KEY_VALUE:False, KEY_TYPE:'boolean'}
+        , KEY_HEC_GZIP_LEVEL: {KEY_VALUE:6, KEY_TYPE:'int'}
+        , KEY_RAW_PASSTHROUGH: {KEY_VALUE:False, KEY_TYPE:'boolean'}
+        , KEY_FLUSH_QUEUE_MAX_BATCHES: {KEY_VALUE:20, KEY_TYPE:'int'}
+        , KEY_FLUSH_QUEUE_MAX_BYTES: {KEY_VALUE:0, KEY_TYPE:'int'}
+        , KEY_HEC_ADAPTIVE_THREADS: {KEY_VALUE:True, KEY_TYPE:'boolean'}
+        , KEY_HEC_MIN_THREADS: {KEY_VALUE:2, KEY_TYPE:'int'}
+        , KEY_HEC_MAX_THREADS: {KEY_VALUE:16, KEY_TYPE:'int'}
+        , KEY_HEC_BATCH_MAX_BYTES: {KEY_VALUE:100000, KEY_TYPE:'int'}
+        , KEY_HEC_BATCH_MAX_EVENTS: {KEY_VALUE:0, KEY_TYPE:'int'}
+        , KEY_HEC_BATCH_AUTOTUNE: {KEY_VALUE:False, KEY_TYPE:'boolean'}
+        , KEY_HEC_RETRY_ATTEMPTS: {KEY_VALUE:5, KEY_TYPE:'int'}
+        , KEY_HEC_RETRY_BASE_DELAY: {KEY_VALUE:500, KEY_TYPE:'int'}
+        , KEY_HEC_RETRY_MAX_DELAY: {KEY_VALUE:10000, KEY_TYPE:'int'}
+        , KEY_HEC_RETRY_RESERVE: {KEY_VALUE:5000, KEY_TYPE:'int'}
+        , KEY_SWEEP_LIST_WORKERS: {KEY_VALUE:8, KEY_TYPE:'int'}
+        , KEY_SWEEP_CURSOR: {KEY_VALUE:'', KEY_TYPE:'string'}
+        , KEY_SWEEP_FULL_RESCAN_EVERY: {KEY_VALUE:48, KEY_TYPE:'int'}
+        , KEY_SCHEDULER_SAFETY_MARGIN: {KEY_VALUE:15000, KEY_TYPE:'int'}
+        , KEY_CHECKPOINT: {KEY_VALUE:'', KEY_TYPE:'string'}
+        , KEY_CHECKPOINT_INTERVAL: {KEY_VALUE:5000, KEY_TYPE:'int'}
+        , KEY_SPILL_DIR: {KEY_VALUE:'', KEY_TYPE:'string'}
+        , KEY_SPILL_MAX_BYTES: {KEY_VALUE:268435456, KEY_TYPE:'int'}
+        , KEY_SPILL_SEGMENT_BYTES: {KEY_VALUE:8388608, KEY_TYPE:'int'}
+        , KEY_HEC_USE_ACK: {KEY_VALUE:False, KEY_TYPE:'boolean'}
+        , KEY_HEC_ACK_POLL_INTERVAL: {KEY_VALUE:1000, KEY_TYPE:'int'}
+        , KEY_HEC_ACK_TIMEOUT: {KEY_VALUE:120000, KEY_TYPE:'int'}
+        , KEY_HEC_BALANCE: {KEY_VALUE:'least_outstanding', KEY_TYPE:'string'}
+        , KEY_HEC_HEALTH_CHECK: {KEY_VALUE:True, KEY_TYPE:'boolean'}
+        , KEY_HEC_EJECT_ERRORS: {KEY_VALUE:3, KEY_TYPE:'int'}
+        , KEY_HEC_EJECT_TIME: {KEY_VALUE:30000, KEY_TYPE:'int'}
+        , KEY_RECORD_FILTER: {KEY_VALUE:'', KEY_TYPE:'string'}
+        , KEY_FIELD_ALLOWLIST: {KEY_VALUE:'', KEY_TYPE:'string'}
+        , KEY_FIELD_DENYLIST: {KEY_VALUE:'', KEY_TYPE:'string'}
+        , KEY_FIELD_MAX_BYTES: {KEY_VALUE:0, KEY_TYPE:'int'}
+        , KEY_DEDUP: {KEY_VALUE:False, KEY_TYPE:'boolean'}
+        , KEY_DEDUP_CAPACITY: {KEY_VALUE:1000000, KEY_TYPE:'int'}
+        , KEY_DEDUP_ERROR_RATE: {KEY_VALUE:0.001, KEY_TYPE:'float'}
+        , KEY_DEDUP_WINDOW: {KEY_VALUE:21600000, KEY_TYPE:'int'}
+        , KEY_DEDUP_STORE: {KEY_VALUE:'', KEY_TYPE:'string'}}
 
     # Master configuration dictionary
     config = dict()
@@ -130,6 +220,9 @@ class ConfigUtil:
                     if self.OPTIONAL_PARAMETERS_DICT[key][self.KEY_TYPE] == 'int':
                         self.config[self.SECTION_OPTIONAL][key] = int(value)
 
+                    elif self.OPTIONAL_PARAMETERS_DICT[key][self.KEY_TYPE] == 'float':
+                        self.config[self.SECTION_OPTIONAL][key] = float(value)
+
                     elif self.OPTIONAL_PARAMETERS_DICT[key][self.KEY_TYPE] == 'boolean':
                         self.config[self.SECTION_OPTIONAL][key] = ast.literal_eval(str(value))
 
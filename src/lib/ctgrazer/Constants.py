@@ -16,13 +16,66 @@ class Constants:
     START_MESSAGE_FORMAT = 'Time_ms=%s START RequestId=%s Severity=%s Function=%s Version=%s Timeout=%d MemoryLimit=%s MB Stream=%s'
     STOP_MESSAGE_FORMAT = 'Time_ms=%d STOP RequestId=%s Severity=%s RemainingTime=%d RunTime=%s ms'
 
-    MAX_BYTE_LENGTH = 100000
+    # bytes of compressed object body read per chunk while streaming records
+    STREAM_CHUNK_SIZE = 65536
+
+    # adaptive HEC concurrency: share of the limit kept after an error, how far above the best
+    # latency a window may run before backing off, and how fast that best latency drifts up
+    HEC_ERROR_DECREASE = 0.5
+    HEC_LATENCY_TOLERANCE = 2.0
+    HEC_BASELINE_DRIFT = 0.05
+
+    # HEC answers worth retrying besides 5xx: request timeout and throttling
+    HEC_RETRY_STATUS = (408, 429)
+
+    # HEC indexer acknowledgment: endpoint, channel header, reply fields and ackIds per poll
+    HEC_ACK_PATH = '/services/collector/ack'
+    HEC_CHANNEL_HEADER = 'X-Splunk-Request-Channel'
+    HEC_ACK_ID = 'ackId'
+    HEC_ACKS = 'acks'
+    HEC_ACK_POLL_MAX = 1000
+
+    # marker appended to a field cut down to field_max_bytes, with the number of bytes cut
+    FIELD_TRUNCATED = '...[truncated {} bytes]'
+
+    # several HEC endpoints: separators in the endpoint setting, balancing methods, health check
+    HEC_ENDPOINT_SEPARATOR = ','
+    HEC_WEIGHT_SEPARATOR = '|'
+    HEC_BALANCE_LEAST_OUTSTANDING = 'least_outstanding'
+    HEC_BALANCE_WEIGHTED_ROUND_ROBIN = 'weighted_round_robin'
+    HEC_HEALTH_PATH = '/services/collector/health'
+
+    # batch size auto-tuning: range searched (in bytes) and posts measured per size
+    HEC_BATCH_TUNE_MIN = 10000
+    HEC_BATCH_TUNE_MAX = 1000000
+    HEC_BATCH_TUNE_SAMPLES = 5
+
+    # object scheduling: bytes per second a worker is assumed to get through before any object
+    # has been measured, and how much longer than its estimate an object is allowed to take
+    SCHEDULER_DEFAULT_RATE = 1000000
+    SCHEDULER_COST_FACTOR = 1.5
+
+    # object tag holding the number of records of the object HEC has confirmed
+    CHECKPOINT_TAG = 'ctgrazer-records'
+
+    # records between looks at whether a new checkpoint is due
+    CHECKPOINT_CHECK_RECORDS = 1000
+
+    # compression of spilled batches, favouring speed as spills happen under pressure
+    SPILL_GZIP_LEVEL = 1
+
+    # most keys S3 accepts in one DeleteObjects call
+    S3_DELETE_BATCH_SIZE = 1000
+
+    # distinct eventTime values remembered by the timestamp converter
+    EVENT_TIME_CACHE_SIZE = 4096
 
     ENCODING_UTF = 'utf-8'
 
     AWS_RECORDS = 'Records'
     AWS_EVENT_SRC = 'eventSource'
     AWS_EVENT_TIME = 'eventTime'
+    AWS_EVENT_ID = 'eventID'
     AWS_S3 = 's3'
     AWS_BUCKET = 'bucket'
     AWS_NAME = 'name'
@@ -30,8 +83,17 @@ class Constants:
     AWS_KEY = 'key'
     AWS_DETAIL_TYPE = 'detail-type'
     AWS_OBJECT = 'object'
+    AWS_CLOUDTRAIL_FOLDER = 'CloudTrail'
+    AWS_EVENT_SRC_S3 = 'aws:s3'
+    AWS_EVENT_SRC_SQS = 'aws:sqs'
+    AWS_SQS_BODY = 'body'
+    AWS_SQS_MESSAGE_ID = 'messageId'
+    AWS_SNS_MESSAGE = 'Message'
+    AWS_BATCH_FAILURES = 'batchItemFailures'
+    AWS_ITEM_IDENTIFIER = 'itemIdentifier'
 
     GRAZER_EVENT_S3_PUT = 's3 Put Trigger'
+    GRAZER_EVENT_SQS = 'SQS Batch Trigger'
     GRAZER_EVENT_SCHEDULED = 'Scheduled Event' #TODO: NOT SURE ABOUT THIS!
     GRAZER_EVENT_UNHANDLED = 'Unhandled Event'
 
@@ -0,0 +1,144 @@
+"""
+Description: Remembers the eventIDs HEC has confirmed, so records seen again, from an object
+notified twice or sent again after a failed invocation, are dropped before they are batched.
+The IDs are kept in Bloom filters with a bounded false positive rate, one per generation: a
+new generation starts once the current one is full or older than the window, and only the
+current and the previous one are kept, so an eventID is remembered for one to two windows.
+The filters can be kept between containers in a local file or an S3 object (s3://bucket/key).
+"""
+
+import hashlib
+import math
+import os
+import threading
+import time
+import zlib
+
+from lib.ctgrazer.Constants import Constants
+from lib.ctgrazer.JsonCodec import JsonCodec
+
+
+class EventDedup:
+
+    S3_SCHEME = 's3://'
+    VERSION = 1
+
+    def __init__(self, capacity, error_rate, window, location='', client=None):
+        self.capacity = capacity
+        self.window = window
+        self.location = location
+        self.client = client
+        # the bits and hashes giving error_rate with 'capacity' IDs in a generation
+        self.bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.hashes = max(1, int(round(self.bits / capacity * math.log(2))))
+        # newest first, each [started, count, bits]
+        self.generations = [self._generation(time.time())]
+        self.lock = threading.Lock()
+        self.changed = False
+        self.duplicates = 0
+        self.added = 0
+
+    # Tells whether the eventID was confirmed before; a false positive drops a new record
+    def seen(self, event_id):
+        positions = self._positions(event_id)
+        for generation in self.generations:
+            bits = generation[2]
+            if all(bits[p >> 3] & (1 << (p & 7)) for p in positions):
+                with self.lock:
+                    self.duplicates += 1
+                return True
+        return False
+
+    # Remembers the eventIDs of records HEC has confirmed
+    def add(self, event_ids):
+        if not event_ids:
+            return
+        with self.lock:
+            for event_id in event_ids:
+                self._rotate(time.time())
+                generation = self.generations[0]
+                for p in self._positions(event_id):
+                    generation[2][p >> 3] |= 1 << (p & 7)
+                generation[1] += 1
+            self.added += len(event_ids)
+            self.changed = True
+
+    # Reads the filters an earlier container stored, if they were made with the same settings
+    def load(self):
+        if not self.location:
+            return
+        try:
+            if self.location.startswith(self.S3_SCHEME):
+                bucket, _, key = self.location[len(self.S3_SCHEME):].partition('/')
+                try:
+                    data = self.client.get_object(Bucket=bucket, Key=key)['Body'].read()
+                except self.client.exceptions.NoSuchKey:
+                    return
+            else:
+                if not os.path.exists(self.location):
+                    return
+                with open(self.location, 'rb') as f:
+                    data = f.read()
+            head, _, body = zlib.decompress(data).partition(b'\n')
+            head = JsonCodec.loads(head)
+        except Exception as error:
+            # without the stored filters, duplicates are only caught from now on
+            print('[WARNING] Unable to read dedup filters from {}: {}'.format(self.location, error))
+            return
+
+        if head.get('version') != self.VERSION or head.get('bits') != self.bits or head.get('hashes') != self.hashes:
+            return
+        size = (self.bits + 7) // 8
+        now = time.time()
+        generations = []
+        for i, (started, count) in enumerate(head['generations']):
+            # a generation older than two windows only holds IDs past their time
+            if now - started < 2 * self.window:
+                generations.append([started, count, bytearray(body[i * size:(i + 1) * size])])
+        with self.lock:
+            if generations:
+                self.generations = generations
+                self._rotate(now)
+
+    # Stores the filters for the next container, when they have changed
+    def save(self):
+        if not self.location or not self.changed:
+            return
+        with self.lock:
+            head = {'version': self.VERSION, 'bits': self.bits, 'hashes': self.hashes,
+                    'generations': [[started, count] for started, count, bits in self.generations]}
+            data = zlib.compress(JsonCodec.dumpb(head) + b'\n' + b''.join(bytes(g[2]) for g in self.generations))
+            self.changed = False
+
+        if self.location.startswith(self.S3_SCHEME):
+            bucket, _, key = self.location[len(self.S3_SCHEME):].partition('/')
+            self.client.put_object(Bucket=bucket, Key=key, Body=data)
+        else:
+            # write next to the file and rename, so a reader never sees half of it
+            temp = self.location + '.tmp'
+            with open(temp, 'wb') as f:
+                f.write(data)
+            os.replace(temp, self.location)
+
+    def getFields(self):
+        with self.lock:
+            return ['DedupDuplicates=%d' % self.duplicates,
+                    'DedupAdded=%d' % self.added,
+                    'DedupGenerations=%d' % len(self.generations),
+                    'DedupEntries=%d' % sum(g[1] for g in self.generations)]
+
+    # the caller holds the lock
+    def _rotate(self, now):
+        current = self.generations[0]
+        if current[1] >= self.capacity or now - current[0] >= self.window:
+            self.generations = [self._generation(now)] + self.generations[:1]
+
+    def _generation(self, started):
+        return [started, 0, bytearray((self.bits + 7) // 8)]
+
+    # double hashing over one digest gives all the bit positions of an ID
+    def _positions(self, event_id):
+        digest = hashlib.blake2b(event_id.encode(Constants.ENCODING_UTF), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
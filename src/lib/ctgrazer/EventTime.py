@@ -0,0 +1,49 @@
+"""
+Description: Converts CloudTrail eventTime values (2014-03-06T21:22:54Z) to UTC epoch
+seconds for the HEC time field
+"""
+
+import calendar
+from datetime import datetime, timezone
+from functools import lru_cache
+
+from lib.ctgrazer.Constants import Constants
+
+
+class EventTime:
+
+    # Returns the UTC epoch seconds of a CloudTrail eventTime
+    @staticmethod
+    def toEpoch(event_time):
+        return _toEpoch(event_time)
+
+    # Converts a whole object's eventTimes at once, each distinct value is parsed only once
+    @staticmethod
+    def toEpochBatch(event_times):
+        converted = {}
+        for event_time in event_times:
+            if event_time not in converted:
+                converted[event_time] = _toEpoch(event_time)
+        return [converted[event_time] for event_time in event_times]
+
+
+# many records share the same second, so remember the most recent conversions
+@lru_cache(maxsize=Constants.EVENT_TIME_CACHE_SIZE)
+def _toEpoch(event_time):
+    # fixed layout YYYY-MM-DDTHH:MM:SSZ, read by position
+    if len(event_time) == 20 and event_time[10] == 'T' and event_time[19] == 'Z':
+        try:
+            return _dayEpoch(event_time[:10]) + int(event_time[11:13]) * 3600 + int(event_time[14:16]) * 60 + int(event_time[17:19])
+        except ValueError:
+            pass
+
+    # anything else, such as fractional seconds, goes through the slower ISO parser
+    parsed = datetime.fromisoformat(event_time.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+@lru_cache(maxsize=64)
+def _dayEpoch(day):
+    return calendar.timegm((int(day[0:4]), int(day[5:7]), int(day[8:10]), 0, 0, 0))
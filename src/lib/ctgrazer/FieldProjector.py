@@ -0,0 +1,125 @@
+"""
+Description: Cuts CloudTrail records down before they are batched. An allowlist keeps only the
+listed dotted paths of a record, a denylist removes paths from it, and any top level field
+whose JSON is over the byte cap is replaced by the start of it followed by a truncation marker.
+Records are encoded once here; those needing no change are passed on as they are.
+"""
+
+from lib.ctgrazer.Constants import Constants
+from lib.ctgrazer.JsonCodec import JsonCodec
+
+
+class FieldProjector:
+
+    PATH_SEPARATOR = ','
+
+    def __init__(self, allow, deny, max_bytes):
+        self.allow = {}
+        for parts in self._paths(allow):
+            node = self.allow
+            for part in parts[:-1]:
+                node = node.setdefault(part, {})
+                if node is True:
+                    break
+            else:
+                node[parts[-1]] = True
+        self.deny = self._paths(deny)
+        # a denied field can only be in a raw record that holds its name
+        self.denyKeys = [b'"' + parts[-1].encode(Constants.ENCODING_UTF) + b'"' for parts in self.deny]
+        self.max_bytes = max_bytes
+
+    # Tells whether a raw record may have something to cut, and so must be parsed
+    def needsParse(self, span):
+        return bool(self.allow) or (self.max_bytes and len(span) > self.max_bytes) or \
+               any(key in span for key in self.denyKeys)
+
+    # Returns the bytes of a raw record after projection, and the number of bytes saved;
+    # 'record' is the parsed record when the caller has it already, it is changed in place
+    def projectRaw(self, span, record=None):
+        if not self.needsParse(span):
+            return span, 0
+        if record is None:
+            record = JsonCodec.loads(span)
+        out = self._encode(self._project(record))
+        return out, len(span) - len(out)
+
+    # Returns the bytes of a parsed record after projection, and the number of bytes saved
+    def project(self, record):
+        encoded = JsonCodec.dumpb(record)
+        if not self.allow and (not self.max_bytes or len(encoded) <= self.max_bytes) and \
+                not any(self._has(record, parts) for parts in self.deny):
+            return encoded, 0
+        out = self._encode(self._project(record))
+        return out, len(encoded) - len(out)
+
+    def _project(self, record):
+        if self.allow:
+            record = self._select(record, self.allow)
+        for parts in self.deny:
+            self._remove(record, parts)
+        return record
+
+    # Encodes the record, cutting every top level field over the cap when the record is
+    def _encode(self, record):
+        encoded = JsonCodec.dumpb(record)
+        if not self.max_bytes or len(encoded) <= self.max_bytes:
+            return encoded
+
+        for key, value in record.items():
+            size = len(JsonCodec.dumpb(value))
+            if size > self.max_bytes:
+                cut = self._cut(value if isinstance(value, str) else JsonCodec.dumps(value))
+                # a marker longer than what it replaces would make the record bigger
+                if cut is not None and len(JsonCodec.dumpb(cut)) < size:
+                    record[key] = cut
+        return JsonCodec.dumpb(record)
+
+    # Returns the longest start of the text that, with the truncation marker, encodes to no more
+    # than the cap as a JSON string, None if not even the marker fits
+    def _cut(self, text):
+        length = len(text.encode(Constants.ENCODING_UTF))
+        # the quotes, and the marker with as many digits as the count can have
+        budget = self.max_bytes - 2 - len(Constants.FIELD_TRUNCATED.format(length))
+        if budget < 0:
+            return None
+        # escaping makes the encoded size grow unevenly, so search the cut by characters
+        low, high = 0, min(len(text), budget)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if len(JsonCodec.dumpb(text[:middle])) - 2 <= budget:
+                low = middle
+            else:
+                high = middle - 1
+        prefix = text[:low]
+        return prefix + Constants.FIELD_TRUNCATED.format(length - len(prefix.encode(Constants.ENCODING_UTF)))
+
+    @staticmethod
+    def _paths(setting):
+        return [path.strip().split('.') for path in setting.split(FieldProjector.PATH_SEPARATOR) if path.strip()]
+
+    @staticmethod
+    def _select(record, tree):
+        out = {}
+        for key, sub in tree.items():
+            if key in record:
+                if sub is True:
+                    out[key] = record[key]
+                elif isinstance(record[key], dict):
+                    out[key] = FieldProjector._select(record[key], sub)
+        return out
+
+    @staticmethod
+    def _has(record, parts):
+        for part in parts:
+            if not isinstance(record, dict) or part not in record:
+                return False
+            record = record[part]
+        return True
+
+    @staticmethod
+    def _remove(record, parts):
+        for part in parts[:-1]:
+            record = record.get(part)
+            if not isinstance(record, dict):
+                return
+        record.pop(parts[-1], None)
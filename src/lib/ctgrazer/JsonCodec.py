@@ -0,0 +1,60 @@
+"""
+Description: JSON codec for the decode and encode hot paths. Uses orjson or simdjson when one
+is bundled in the deployment package (under /lib or at the top level) and falls back to the
+standard library json module otherwise
+"""
+
+import importlib
+import json
+
+
+def _load(name):
+    for module_name in ('lib.' + name, name):
+        try:
+            return importlib.import_module(module_name)
+        except ImportError:
+            continue
+    return None
+
+
+_orjson = _load('orjson')
+_simdjson = _load('simdjson') if _orjson is None else None
+
+if _orjson is not None:
+    _backend = 'orjson'
+    _loads = _orjson.loads
+    _dumpb = _orjson.dumps
+
+    def _dumps(obj):
+        return _orjson.dumps(obj).decode()
+
+elif _simdjson is not None:
+    # simdjson only parses, serializing stays with the standard library
+    _backend = 'simdjson'
+    _loads = _simdjson.loads
+    _dumps = json.dumps
+
+else:
+    _backend = 'json'
+    _loads = json.loads
+    _dumps = json.dumps
+
+
+if _orjson is None:
+    def _dumpb(obj):
+        return _dumps(obj).encode('utf-8')
+
+
+class JsonCodec:
+
+    # Name of the active backend
+    BACKEND = _backend
+
+    # Parses str or bytes into Python objects
+    loads = staticmethod(_loads)
+
+    # Serializes to a str
+    dumps = staticmethod(_dumps)
+
+    # Serializes to UTF-8 bytes
+    dumpb = staticmethod(_dumpb)
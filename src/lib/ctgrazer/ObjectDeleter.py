@@ -0,0 +1,87 @@
+"""
+Description: Removes processed S3 objects with multi-object DeleteObjects calls. Keys are
+collected per bucket and sent in batches of up to 1000 by a background thread, so the
+deletes overlap with the processing of the next objects.
+"""
+
+import threading
+import queue as Queue
+
+from lib.ctgrazer.Constants import Constants, Level
+
+
+class ObjectDeleter:
+
+    def __init__(self, client, Logger, batch_size=Constants.S3_DELETE_BATCH_SIZE):
+        self.client = client
+        self.Logger = Logger
+        # S3 refuses more than 1000 keys in one call
+        self.batch_size = max(1, min(batch_size, Constants.S3_DELETE_BATCH_SIZE))
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.removed = 0
+        self.failed = 0
+        # (bucket, key) of every object confirmed gone
+        self.removedKeys = set()
+
+        self.deleteQueue = Queue.Queue()
+        self.thread = threading.Thread(target=self._deleteThread)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Marks an object as processed; it is removed with the next full batch or on close()
+    def add(self, bucket, key):
+        with self.lock:
+            keys = self.pending.setdefault(bucket, [])
+            keys.append(key)
+            if len(keys) >= self.batch_size:
+                self.deleteQueue.put((bucket, keys))
+                del self.pending[bucket]
+
+    # Sends what is left and waits for every delete to finish. Returns the number of
+    # objects that could not be removed
+    def close(self):
+        with self.lock:
+            for bucket, keys in self.pending.items():
+                self.deleteQueue.put((bucket, keys))
+            self.pending = {}
+        self.deleteQueue.put(None)
+        self.thread.join()
+
+        if self.removed or self.failed:
+            self.Logger.sendEvent('Objects Removed:' + str(self.removed) + ' Failed:' + str(self.failed))
+        return self.failed
+
+    def _deleteThread(self):
+        while True:
+            item = self.deleteQueue.get()
+            if item is None:
+                return
+            self._deleteBatch(*item)
+
+    def _deleteBatch(self, bucket, keys):
+        try:
+            response = self.client.delete_objects(Bucket=bucket,
+                                                  Delete={'Objects': [{'Key': key} for key in keys],
+                                                          'Quiet': False})
+        except Exception as error:
+            # the whole call failed, none of the keys are known to be gone
+            for key in keys:
+                self._reportError(bucket, key, str(error))
+            return
+
+        for deleted in response.get('Deleted', []):
+            self.removed += 1
+            self.removedKeys.add((bucket, deleted['Key']))
+            self.Logger.sendEvent('Removed Obj: ' + self._sourceName(bucket, deleted['Key']))
+
+        for error in response.get('Errors', []):
+            self._reportError(bucket, error.get('Key'), str(error.get('Code')) + ' ' + str(error.get('Message')))
+
+    def _reportError(self, bucket, key, reason):
+        self.failed += 1
+        self.Logger.sendEvent('Unable to Remove Obj:' + self._sourceName(bucket, key) + ' Reason:' + reason, severity=Level.ERROR)
+
+    @staticmethod
+    def _sourceName(bucket, key):
+        return 's3://' + bucket + '/' + str(key)
@@ -0,0 +1,60 @@
+"""
+Description: Hands out the objects of an invocation oldest first and stops handing them out
+once the Lambda's remaining time, less a safety margin for draining HEC, can't cover the next
+one. An object's cost is estimated from its size and the throughput measured so far.
+"""
+
+import threading
+from collections import deque
+
+from lib.ctgrazer.Constants import Constants
+
+
+class ObjectScheduler:
+
+    # objects are (bucket, key, size, modified) tuples; remaining_time returns milliseconds
+    def __init__(self, objects, remaining_time, margin_ms, default_rate=Constants.SCHEDULER_DEFAULT_RATE):
+        # oldest first, listing order among equals
+        self.pending = deque(sorted(objects, key=lambda o: o[3]))
+        self.remaining_time = remaining_time
+        self.margin_ms = margin_ms
+        self.default_rate = default_rate
+        self.bytes_done = 0
+        self.seconds_done = 0.0
+        self.deferred = []
+        self.lock = threading.Lock()
+
+    # Returns the next object to process, None once there are none left or no time for them
+    def next(self):
+        with self.lock:
+            if not self.pending:
+                return None
+            obj = self.pending[0]
+            if self.remaining_time() - self.margin_ms < self._estimate(obj[2]):
+                # out of time; the rest stay in the bucket for the next sweep
+                self.deferred.extend(self.pending)
+                self.pending.clear()
+                return None
+            return self.pending.popleft()
+
+    # Records how long an object took, sharpening the estimates for the ones after it
+    def done(self, obj, seconds):
+        with self.lock:
+            self.bytes_done += obj[2]
+            self.seconds_done += seconds
+
+    # Returns the milliseconds an object of 'size' bytes is expected to take
+    def _estimate(self, size):
+        rate = self._rate()
+        return size / rate * 1000 * Constants.SCHEDULER_COST_FACTOR
+
+    # bytes (as stored in S3) a single object worker gets through per second
+    def _rate(self):
+        if self.bytes_done > 0 and self.seconds_done > 0:
+            return self.bytes_done / self.seconds_done
+        return self.default_rate
+
+    def getFields(self):
+        with self.lock:
+            return ['SchedulerRate=%d' % self._rate(),
+                    'SchedulerDeferred=%d' % len(self.deferred)]
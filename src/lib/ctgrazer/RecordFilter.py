@@ -0,0 +1,124 @@
+"""
+Description: Rule engine deciding which CloudTrail records are sent at all. Rules are
+separated by ';' and tried in order, the first one matching a record decides:
+
+    drop eventName=Describe*|Get*|List* userIdentity.type=AWSService; sample:10 readOnly=true
+
+A rule is an action (drop, keep or sample:N, which keeps 1 in N of the records it matches)
+followed by conditions 'field=pattern[|pattern...]' that must all hold. Fields are dotted
+paths such as eventSource, eventName, readOnly, userIdentity.type or awsRegion; patterns are
+shell style (fnmatch). Records no rule matches are kept. The rules are compiled once into
+regular expressions. A raw record is only parsed when the name of a field the rules look at
+appears in it, as a key of that name may also sit in a nested object such as
+requestParameters; one holding none of them is decided without being parsed.
+"""
+
+import fnmatch
+import re
+
+from lib.ctgrazer.Constants import Constants
+from lib.ctgrazer.JsonCodec import JsonCodec
+
+
+class RecordFilterError(Exception): pass
+
+
+class RecordFilter:
+
+    DROP = 'drop'
+    KEEP = 'keep'
+    SAMPLE = 'sample'
+
+    RULE_SEPARATOR = ';'
+    PATTERN_SEPARATOR = '|'
+
+    def __init__(self, rules):
+        self.rules = []
+        self.fields = []
+        for text in rules.split(self.RULE_SEPARATOR):
+            words = text.split()
+            if words:
+                self.rules.append(self._compile(words))
+        # the keys a raw record must hold for any field to be there
+        self.keys = set(b'"' + path.split('.')[-1].encode(Constants.ENCODING_UTF) + b'"' for path in self.fields)
+
+    # Returns one hit counter per rule, for a caller to pass to keep() over an object
+    def counters(self):
+        return [0] * len(self.rules)
+
+    # Tells whether a parsed record is to be sent
+    def keep(self, record, counters):
+        return self._decide({path: self._lookup(record, path) for path in self.fields}, counters)
+
+    # Tells whether a raw record must be parsed to be decided, that is when it holds the name
+    # of a field the rules look at
+    def needsParse(self, span):
+        return any(key in span for key in self.keys)
+
+    # Tells whether the raw bytes of a record are to be sent; 'record' is the parsed record
+    # when the caller has it already
+    def keepRaw(self, span, counters, record=None):
+        if record is None:
+            if not self.needsParse(span):
+                return self._decide(dict.fromkeys(self.fields), counters)
+            record = JsonCodec.loads(span)
+        return self.keep(record, counters)
+
+    # Returns the hits of each rule as fields for the log
+    def getFields(self, counters):
+        return ['Filter%dHits=%d' % (i, hits) for i, hits in enumerate(counters, 1)]
+
+    def _decide(self, values, counters):
+        for i, (action, every, conditions) in enumerate(self.rules):
+            for path, pattern in conditions:
+                value = values[path]
+                if value is None or not pattern.match(value):
+                    break
+            else:
+                return self._apply(i, action, every, counters)
+        return True
+
+    def _apply(self, i, action, every, counters):
+        counters[i] += 1
+        if action == self.SAMPLE:
+            # keep the first of every N records the rule matches
+            return (counters[i] - 1) % every == 0
+        return action == self.KEEP
+
+    def _compile(self, words):
+        action, _, every = words[0].partition(':')
+        if action == self.SAMPLE:
+            try:
+                every = int(every)
+            except ValueError:
+                raise RecordFilterError('Sample rate must be a number: {}'.format(words[0]))
+            if every < 1:
+                raise RecordFilterError('Sample rate must be at least 1: {}'.format(words[0]))
+        elif action not in (self.DROP, self.KEEP) or every:
+            raise RecordFilterError('Unknown filter action: {}'.format(words[0]))
+
+        conditions = []
+        for word in words[1:]:
+            path, equals, patterns = word.partition('=')
+            if not equals or not path or not patterns:
+                raise RecordFilterError('Filter condition must be field=pattern: {}'.format(word))
+            pattern = re.compile('|'.join('(?:' + fnmatch.translate(p) + ')'
+                                          for p in patterns.split(self.PATTERN_SEPARATOR)))
+            if path not in self.fields:
+                self.fields.append(path)
+            conditions.append((path, pattern))
+        return action, every, conditions
+
+    # Returns the value at a dotted path of a parsed record as text, None if it isn't there
+    @staticmethod
+    def _lookup(record, path):
+        value = record
+        for part in path.split('.'):
+            if not isinstance(value, dict):
+                return None
+            value = value.get(part)
+        if value is None or isinstance(value, (dict, list)):
+            return None
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        return str(value)
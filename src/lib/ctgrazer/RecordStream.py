@@ -0,0 +1,171 @@
+"""
+Description: Incremental reader for gzipped CloudTrail log objects. The S3 body is
+decompressed chunk by chunk and the entries of the top level 'Records' array are
+handed out one at a time, so memory is bounded by a single record and not by the object.
+"""
+
+import re
+import zlib
+
+from lib.ctgrazer.Constants import Constants
+from lib.ctgrazer.JsonCodec import JsonCodec
+
+
+class RecordStreamError(Exception): pass
+
+
+class RecordStream:
+
+    # everything up to and including the next quote or bracket outside of a JSON string
+    TOKEN = re.compile(rb'[^"{}\[\]]*(["{}\[\]])')
+
+    # the rest of a JSON string up to its closing quote; stops in front of a backslash ending
+    # the buffer, as the character it escapes is in the next chunk
+    STRING = re.compile(rb'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL)
+
+    # the text in front of the array holding the records
+    RECORDS_KEY = re.compile(rb'"' + Constants.AWS_RECORDS.encode(Constants.ENCODING_UTF) + rb'"\s*:\s*$')
+
+    # the eventTime of a record, read straight from its bytes
+    EVENT_TIME = re.compile(rb'"' + Constants.AWS_EVENT_TIME.encode(Constants.ENCODING_UTF) + rb'"\s*:\s*"([^"]*)"')
+
+    # the eventID key as it appears in a record
+    EVENT_ID_KEY = b'"' + Constants.AWS_EVENT_ID.encode(Constants.ENCODING_UTF) + b'"'
+
+    # accept both gzip and zlib headers
+    GZIP_WBITS = zlib.MAX_WBITS | 32
+
+    QUOTE = ord('"')
+    OPEN_OBJECT = ord('{')
+    OPEN_ARRAY = ord('[')
+
+    def __init__(self, body, chunk_size=Constants.STREAM_CHUNK_SIZE):
+        self.body = body
+        self.chunk_size = chunk_size
+
+    # Returns the eventTime of a raw record without parsing it, None if it has none
+    @staticmethod
+    def eventTime(span):
+        match = RecordStream.EVENT_TIME.search(span)
+        if match is None:
+            return None
+        return match.group(1).decode(Constants.ENCODING_UTF)
+
+    # Tells whether the name eventID appears in a raw record, at the top level or nested
+    @staticmethod
+    def hasEventId(span):
+        return RecordStream.EVENT_ID_KEY in span
+
+    # Returns the eventID of a raw record, None if it has none. It follows requestParameters and
+    # responseElements, which may hold an eventID of their own, so the record is parsed to be
+    # sure of the top level one unless the name doesn't appear at all; 'record' is the parsed
+    # record when the caller has it already
+    @staticmethod
+    def eventId(span, record=None):
+        if record is None:
+            if not RecordStream.hasEventId(span):
+                return None
+            record = JsonCodec.loads(span)
+        event_id = record.get(Constants.AWS_EVENT_ID)
+        return event_id if isinstance(event_id, str) else None
+
+    # Yields each CloudTrail record as a dictionary
+    def records(self):
+        for span in self.spans():
+            yield JsonCodec.loads(span)
+
+    # Yields the raw bytes of each entry in the 'Records' array, exactly as found in the object.
+    # The scan state is kept across chunks, so every byte is scanned once however long the
+    # strings running over chunk boundaries are
+    def spans(self):
+        buf = bytearray()
+        pos = 0             # next position to scan in buf
+        mark = 0            # end of the last bracket, where the text in front of the next starts
+        start = -1          # start of the record being scanned, -1 when between records
+        depth = 0
+        in_string = False
+        in_records = False
+
+        for chunk in self._chunks():
+            # drop everything that has already been handed out before growing the buffer
+            keep = start if start >= 0 else pos if in_records else mark
+            if keep:
+                del buf[:keep]
+                pos -= keep
+                mark -= keep
+                if start >= 0:
+                    start -= keep
+            buf += chunk
+            end = len(buf)
+
+            while pos < end:
+                if in_string:
+                    pos = self.STRING.match(buf, pos).end()
+                    if pos == end or buf[pos] != self.QUOTE:
+                        # the string goes on in the next chunk
+                        break
+                    pos += 1
+                    in_string = False
+                    continue
+
+                match = self.TOKEN.match(buf, pos)
+                if match is None:
+                    # nothing but plain values up to the end of the chunk
+                    pos = end
+                    break
+                token = buf[match.start(1)]
+                pos = match.end()
+
+                if token == self.QUOTE:
+                    in_string = True
+                    continue
+
+                if token == self.OPEN_OBJECT or token == self.OPEN_ARRAY:
+                    if in_records:
+                        if depth == 2:
+                            start = match.start(1)
+                    elif depth == 1 and token == self.OPEN_ARRAY and \
+                            self.RECORDS_KEY.search(buf, mark, match.start(1)):
+                        in_records = True
+                    depth += 1
+
+                else:
+                    depth -= 1
+                    if in_records:
+                        if depth == 2:
+                            yield bytes(buf[start:pos])
+                            start = -1
+                        elif depth == 1:
+                            # end of the 'Records' array, nothing else is of interest
+                            return
+                mark = pos
+
+        raise RecordStreamError('Incomplete CloudTrail object: end of the Records array not found')
+
+    # Yields decompressed chunks of the body, handling concatenated gzip members
+    def _chunks(self):
+        decompressor = zlib.decompressobj(self.GZIP_WBITS)
+        while True:
+            try:
+                data = self.body.read(self.chunk_size)
+            except Exception as error:
+                raise RecordStreamError('Unable to read object stream: {}'.format(error))
+            if not data:
+                break
+
+            while data:
+                try:
+                    out = decompressor.decompress(data)
+                except zlib.error as error:
+                    raise RecordStreamError('Unable to decompress object stream: {}'.format(error))
+                if out:
+                    yield out
+                if decompressor.eof and decompressor.unused_data:
+                    data = decompressor.unused_data
+                    decompressor = zlib.decompressobj(self.GZIP_WBITS)
+                else:
+                    data = None
+
+        tail = decompressor.flush()
+        if tail:
+            yield tail
@@ -1,11 +1,16 @@
 import time
-import json
-import lib.requests as requests
+import uuid
+import heapq
+import random
+import zlib
 import threading
 import logging
 import urllib.parse as urlparse
 from lib.ctgrazer.ConfigUtil import ConfigUtil
 from lib.ctgrazer.Constants import Constants, Level, EventMeta
+from lib.ctgrazer.JsonCodec import JsonCodec
+from lib.ctgrazer.Startup import Startup
+from lib.ctgrazer.SpillStore import SpillStore, SpilledObject
 
 try:
     import Queue
@@ -16,12 +21,35 @@ from time import sleep
 # create a local for the threads to log errors
 error_lock = threading.Lock()
 
+# HEC sessions live at module scope so a warm container keeps reusing its open
+# connections across invocations. Keyed by (endpoint, sender slot) -> [session, last used]
+hec_sessions = {}
+session_lock = threading.Lock()
+
+# batch size searches, kept per endpoint so a warm container carries on where it left off
+batch_tuners = {}
+
+
+# requests is only loaded once a HEC logger is built, CloudWatch logging never needs it
+requests = None
+
+
+def _loadRequests():
+    global requests
+    if requests is None:
+        module = Startup.load('lib.requests')
+        # HEC is posted to with verify=False, silence the warning for it once per container
+        module.packages.urllib3.disable_warnings()
+        requests = module
+    return requests
+
 
 class SendMessage:
 
     def __init__(self,
                  context,
-                 config
+                 config,
+                 number_of_threads=None
                 ):
 
         # Set some variables from context object
@@ -39,12 +67,26 @@ class SendMessage:
 
         # Used for collecting batch events
         self.batchEvents       = []
+        # source -> [first, last] record numbers of that source in the batch
+        self.batchSources      = {}
+        # source -> last record number of that source in an earlier batch
+        self.sourceMarks       = {}
         self.currentByteLength = 0
-        self.maxByteLength     = Constants.MAX_BYTE_LENGTH
+        self.maxByteLength     = config.get_config_value(ConfigUtil.KEY_HEC_BATCH_MAX_BYTES)
+        self.maxEvents         = config.get_config_value(ConfigUtil.KEY_HEC_BATCH_MAX_EVENTS)
         self.errorMessage      = ''
 
+        # object workers share the batch, so guard it
+        self.batchLock         = threading.Lock()
+
+        # serialized envelope heads for raw records, keyed by (sourcetype, source)
+        self.rawEnvelopes      = {}
+
         self.debug = self.config.get_config_value(ConfigUtil.KEY_DEBUG)
-        self.number_of_threads = self.config.get_config_value(ConfigUtil.KEY_BATCH_THREAD_SIZE)
+        # the caller may size the threads for this invocation, the shared config stays untouched
+        if number_of_threads is None:
+            number_of_threads = self.config.get_config_value(ConfigUtil.KEY_BATCH_THREAD_SIZE)
+        self.number_of_threads = number_of_threads
         self.message_prefix = self.config.get_config_value(ConfigUtil.KEY_LOG_MSG_PREFIX)
         destination = self.config.get_config_value(ConfigUtil.KEY_LOG_DESTINATION)
 
@@ -52,7 +94,8 @@ class SendMessage:
         self.http_event_collector_server_uri = self.config.get_config_value(ConfigUtil.KEY_SPLUNK_HEC_ENDPOINT)
         self.source_type = self.config.get_config_value(ConfigUtil.KEY_SOURCE_TYPE)
         self.debug_source_type = self.config.get_config_value(ConfigUtil.KEY_SPLUNK_DEBUG_SOURCETYPE)
-        self.http_event_collector_host = self._getHostName(self.http_event_collector_server_uri)
+        # with a list of endpoints, events carry the host of the first one
+        self.http_event_collector_host = self._getHostName(self.http_event_collector_server_uri.split(Constants.HEC_ENDPOINT_SEPARATOR)[0])
 
         # create a logger instance in case anything needs to go to CloudWatch
         self.cw_logger = logging.getLogger()
@@ -70,7 +113,33 @@ class SendMessage:
                                             self.cw_logger,
                                             number_of_threads  = self.number_of_threads,
                                             maxByteLength      = self.maxByteLength,
-                                            debug              = self.debug
+                                            debug              = self.debug,
+                                            pool_size          = self.config.get_config_value(ConfigUtil.KEY_HEC_POOL_SIZE),
+                                            keep_alive         = self.config.get_config_value(ConfigUtil.KEY_HEC_KEEP_ALIVE),
+                                            idle_timeout       = self.config.get_config_value(ConfigUtil.KEY_HEC_IDLE_TIMEOUT),
+                                            compress           = self.config.get_config_value(ConfigUtil.KEY_HEC_GZIP),
+                                            compress_level     = self.config.get_config_value(ConfigUtil.KEY_HEC_GZIP_LEVEL),
+                                            queue_max_batches  = self.config.get_config_value(ConfigUtil.KEY_FLUSH_QUEUE_MAX_BATCHES),
+                                            queue_max_bytes    = self.config.get_config_value(ConfigUtil.KEY_FLUSH_QUEUE_MAX_BYTES),
+                                            adaptive           = self.config.get_config_value(ConfigUtil.KEY_HEC_ADAPTIVE_THREADS),
+                                            min_threads        = self.config.get_config_value(ConfigUtil.KEY_HEC_MIN_THREADS),
+                                            max_threads        = self.config.get_config_value(ConfigUtil.KEY_HEC_MAX_THREADS),
+                                            autotune           = self.config.get_config_value(ConfigUtil.KEY_HEC_BATCH_AUTOTUNE),
+                                            retry_attempts     = self.config.get_config_value(ConfigUtil.KEY_HEC_RETRY_ATTEMPTS),
+                                            retry_base_delay   = self.config.get_config_value(ConfigUtil.KEY_HEC_RETRY_BASE_DELAY),
+                                            retry_max_delay    = self.config.get_config_value(ConfigUtil.KEY_HEC_RETRY_MAX_DELAY),
+                                            retry_reserve      = self.config.get_config_value(ConfigUtil.KEY_HEC_RETRY_RESERVE),
+                                            remaining_time     = context.get_remaining_time_in_millis,
+                                            spill_dir          = self.config.get_config_value(ConfigUtil.KEY_SPILL_DIR),
+                                            spill_max_bytes    = self.config.get_config_value(ConfigUtil.KEY_SPILL_MAX_BYTES),
+                                            spill_segment_bytes = self.config.get_config_value(ConfigUtil.KEY_SPILL_SEGMENT_BYTES),
+                                            use_ack            = self.config.get_config_value(ConfigUtil.KEY_HEC_USE_ACK),
+                                            ack_poll_interval  = self.config.get_config_value(ConfigUtil.KEY_HEC_ACK_POLL_INTERVAL),
+                                            ack_timeout        = self.config.get_config_value(ConfigUtil.KEY_HEC_ACK_TIMEOUT),
+                                            balance            = self.config.get_config_value(ConfigUtil.KEY_HEC_BALANCE),
+                                            health_check       = self.config.get_config_value(ConfigUtil.KEY_HEC_HEALTH_CHECK),
+                                            eject_errors       = self.config.get_config_value(ConfigUtil.KEY_HEC_EJECT_ERRORS),
+                                            eject_time         = self.config.get_config_value(ConfigUtil.KEY_HEC_EJECT_TIME)
                                           )
 
             # if issue with setting up object (threading/queuing) revert back to CW
@@ -84,8 +153,10 @@ class SendMessage:
     def kill(self):
         if self._isSplunk():
             # if there is still some batch events to send, do it
-            if( len(self.batchEvents) > 0 ):
-                self.httpObject._sendEvent(self.batchEvents)
+            with self.batchLock:
+                self._flushBatch()
+            # let everything queued so far go out, so the stop record accounts for all of it
+            self.httpObject._waitForQueue()
             # we are done' send the stop record
         self._sendStopRecord()
         if self._isSplunk():
@@ -95,7 +166,7 @@ class SendMessage:
         del self
 
     def isError(self):
-        if( self.httpObject.error[Constants.COUNT] > 0):
+        if( self._isSplunk() and self.httpObject.error[Constants.COUNT] > 0):
             msg = self.httpObject.error.get(Constants.MSG, {})
             self.errorMessage = 'TEXT:' + str(msg.get(Constants.TXT, 'NO_VALUE')) + ' CODE:' + str(msg.get(Constants.CODE, 'NO_VALUE')) + ' REASON:' + str(msg.get(Constants.REASON, 'NO_VALUE'))
             self.cw_logger.error('ERROR IN SENDING DATA'+self.errorMessage)
@@ -103,8 +174,75 @@ class SendMessage:
         else:
             return False
 
+    # Blocks until every batch holding events of 'source' has been confirmed by HEC or given up on.
+    # Returns True only if all of them were confirmed, so the source object can be removed.
+    def waitForSource(self, source):
+        if not self._isSplunk():
+            return True
+        with self.batchLock:
+            # the last events of the source may still be waiting for a full batch
+            if source in self.batchSources:
+                self._flushBatch()
+            self.sourceMarks.pop(source, None)
+        return self.httpObject._waitForSource(source)
+
+    # Counts the records of 'source' that HEC has confirmed without a gap, starting from the
+    # 'records' already confirmed by an earlier attempt at the object
+    def startSource(self, source, records=0):
+        if self._isSplunk():
+            with self.batchLock:
+                self.sourceMarks[source] = records
+            self.httpObject.tracker.start(source, records)
+
+    # Returns how many leading records of 'source' HEC has confirmed so far
+    def confirmedRecords(self, source):
+        if not self._isSplunk():
+            return 0
+        return self.httpObject.tracker.watermark(source)
+
+    # Sends the batches an earlier invocation spilled to disk, and waits for them to be handled
+    # before any new work is queued. Returns the number of batches replayed and a SpilledObject
+    # for each source they came from
+    def replaySpill(self):
+        if not self._isSplunk():
+            return 0, {}
+        return self.httpObject._replaySpill()
+
+    # Notes what became of 'source' when some of its batches were spilled: its number of records,
+    # None unless it was read to the end, and the eventIDs of its records as (record, eventID).
+    # Returns True if there was anything to note, the replay then finishes the object off
+    def noteSource(self, source, records=None, event_ids=()):
+        if not self._isSplunk():
+            return False
+        return self.httpObject._noteSource(source, records, event_ids)
+
+    # Returns the bytes posted to HEC so far as (raw, sent); they differ when compression is on
+    def getByteCounts(self):
+        if not self._isSplunk():
+            return (0, 0)
+        return self.httpObject._getByteCounts()
+
+    def _stopFields(self):
+        fields = []
+        if self._isSplunk():
+            raw_bytes, sent_bytes = self.getByteCounts()
+            fields.append('BytesRaw=%d' % raw_bytes)
+            fields.append('BytesSent=%d' % sent_bytes)
+            fields.extend(self.httpObject._getQueueFields())
+            fields.extend(self.httpObject._getConcurrencyFields())
+            fields.extend(self.httpObject._getBatchFields())
+            fields.extend(self.httpObject._getRetryFields())
+            fields.extend(self.httpObject._getSpillFields())
+            fields.extend(self.httpObject._getAckFields())
+            fields.extend(self.httpObject.endpoints.getFields())
+        return fields
+
+    def _startFields(self):
+        return ['JsonCodec=' + JsonCodec.BACKEND] + Startup.getFields()
+
     def _sendStartRecord(self):
         message = Constants.START_MESSAGE_FORMAT % (self.startms, self.request_id, Level.INFO, self.function_arn, self.function_version, self.start, self.memory_limit, self.log_stream_name)
+        message = ' '.join([message] + self._startFields())
         if self._isSplunk():
             event = []
             event.append(self._packageEvent(message))
@@ -115,6 +253,7 @@ class SendMessage:
     def _sendStopRecord(self):
         elapsedTime = int(round(time.time() * 1000)) - int(self.startms)
         message = Constants.STOP_MESSAGE_FORMAT % (int(round(time.time() * 1000)), self.request_id, Level.INFO, self.context.get_remaining_time_in_millis(), elapsedTime)
+        message = ' '.join([message] + self._stopFields())
         if self._isSplunk():
             event = []
             event.append(self._packageEvent(message))
@@ -138,14 +277,14 @@ class SendMessage:
                 event.append(self._packageEvent(message))
                 self.httpObject._sendEvent(event)
             else:
-                self._sendToCloudWatch(self, severity, message)
+                self._sendToCloudWatch(severity, message)
         elif(isinstance(payload, dict)):
             if(len(payload) <= 0):
                 self.cw_logger.error('EMPTY DICTIONARY MESSAGE SENT')
                 return
             if( self._validateDictonary(payload) ):
                 event = []
-                event.append(json.dumps(payload))
+                event.append(JsonCodec.dumpb(payload))
                 self.httpObject._sendEvent(event)
             else:
                 self.cw_logger.error('PAYLOAD DID NOT PASS VALIDATION')
@@ -166,9 +305,11 @@ class SendMessage:
        else:
             self.cw_logger.info(message)
 
+    # 'record' numbers the events of a source from 1, for checkpointing
     def batchEvent(self,
                    payload,
-                   severity=Level.INFO):
+                   severity=Level.INFO,
+                   record=None):
 
         if(isinstance(payload, str)):
             if(len(payload) <= 0):
@@ -177,42 +318,87 @@ class SendMessage:
             severity = self._determineSeverity(severity)
             message = self.message_prefix % (int(round(time.time() * 1000)), self.request_id, severity, payload)
             if self._isSplunk():
-                payLoadString = self._packageEvent(message)
-                payLoadLength = len(payLoadString)
-
-                # if the new event pushes us over the max OR
-                # the array is empty (avoid sending 0 events
-                if( ( ( self.currentByteLength+payLoadLength ) > self.maxByteLength ) and
-                    ( len(self.batchEvents)  != 0 ) ):
-                    # This will push us over the limit, so send the array of dictionaries to splunk
-                    self.httpObject._sendEvent(self.batchEvents.copy())
-                    self.batchEvents       = []
-                    self.currentByteLength = 0
-                self.batchEvents.append(payLoadString)
-                self.currentByteLength += payLoadLength
+                self._addToBatch(self._packageEvent(message))
             else:
-                self._sendToCloudWatch(self, severity, message)
+                self._sendToCloudWatch(severity, message)
         elif(isinstance(payload, dict)):
             if(len(payload) <= 0):
                 self.cw_logger.error('EMPTY DICTIONARY BATCH MESSAGE SENT')
                 return
             if( self._validateDictonary(payload) ):
-                payLoadString = json.dumps(payload)
-                payLoadLength = len(payLoadString)
-
-                if( ( ( self.currentByteLength+payLoadLength ) > self.maxByteLength ) and
-                    ( len(self.batchEvents)  != 0 ) ):
-                    # This will push us over the limit, so send the array of dictionaries to splunk
-                    self.httpObject._sendEvent(self.batchEvents.copy())
-                    self.batchEvents       = []
-                    self.currentByteLength = 0
-                self.batchEvents.append(payLoadString)
-                self.currentByteLength += payLoadLength
+                if self._isSplunk():
+                    self._addToBatch(JsonCodec.dumpb(payload), payload[EventMeta.SOURCE.value], record)
+                else:
+                    self.cw_logger.info(JsonCodec.dumps(payload))
             else:
                 self.cw_logger.error('PAYLOAD DID NOT PASS VALIDATION')
         else:
             self.cw_logger.error('NOT A VALID PAYLOAD FORMAT: {}'.format(type(payload)))
 
+    def batchRawEvent(self,
+                      source_type,
+                      source,
+                      event_time,
+                      raw,
+                      record=None):
+        # the record is written into the envelope as it was found in the S3 object,
+        # so it is never parsed into a dictionary or serialized again
+        envelope = self.rawEnvelopes.get((source_type, source))
+        if envelope is None:
+            head = {EventMeta.SOURCE_TYPE.value: source_type,
+                    EventMeta.SOURCE.value: source,
+                    EventMeta.HOST.value: self.http_event_collector_host}
+            envelope = JsonCodec.dumpb(head)[:-1]
+            self.rawEnvelopes[(source_type, source)] = envelope
+
+        if event_time is None:
+            payLoad = b''.join((envelope, b', "event": ', raw, b'}'))
+        else:
+            payLoad = b''.join((envelope, b', "time": ', JsonCodec.dumpb(event_time), b', "event": ', raw, b'}'))
+
+        if self._isSplunk():
+            self._addToBatch(payLoad, source, record)
+        else:
+            self.cw_logger.info(payLoad.decode(Constants.ENCODING_UTF))
+
+    def _addToBatch(self, payLoad, source=None, record=None):
+        # sizes are in encoded bytes, counting the separator each event adds to the post body
+        payLoadLength = len(payLoad) + 1
+        with self.batchLock:
+            maxByteLength = self.httpObject._getBatchLimit()
+            # if the new event pushes us over the max (or the event limit) AND
+            # the array is not empty (avoid sending 0 events)
+            if( ( ( ( self.currentByteLength+payLoadLength ) > maxByteLength ) or
+                  ( self.maxEvents > 0 and len(self.batchEvents) >= self.maxEvents ) ) and
+                ( len(self.batchEvents)  != 0 ) ):
+                # This will push us over the limit, so send the array of dictionaries to splunk
+                self._flushBatch(maxByteLength)
+            self.batchEvents.append(payLoad)
+            self.currentByteLength += payLoadLength
+            if source is not None:
+                # a worker adds the records of its object in order, so they form one run per batch
+                span = self.batchSources.get(source)
+                if span is None:
+                    # records filtered out since the source's last batch need no confirmation,
+                    # so the run starts right after that batch
+                    first = record
+                    if record is not None and source in self.sourceMarks:
+                        first = self.sourceMarks[source] + 1
+                    self.batchSources[source] = [first, record]
+                elif record is not None:
+                    span[1] = record
+                if record is not None and source in self.sourceMarks:
+                    self.sourceMarks[source] = record
+
+    # hands the current batch to the sender threads, the caller holds batchLock
+    def _flushBatch(self, maxByteLength=None):
+        if len(self.batchEvents) == 0:
+            return
+        self.httpObject._sendEvent(self.batchEvents, self.currentByteLength, maxByteLength, self.batchSources)
+        self.batchEvents       = []
+        self.batchSources      = {}
+        self.currentByteLength = 0
+
     def _validateDictonary(self, payload):
         if EventMeta.HOST.value not in payload:
             payload.update({EventMeta.HOST.value: self.http_event_collector_host })
@@ -236,7 +422,7 @@ class SendMessage:
         payload.update({EventMeta.TIME.value: eventtime})
         payload.update({EventMeta.HOST.value: self.http_event_collector_host})
         payload.update({EventMeta.EVENT.value: message})
-        return json.dumps(payload)
+        return JsonCodec.dumpb(payload)
 
     def _determineSeverity(self, severity):
         if not Level.__contains__(severity):
@@ -266,6 +452,32 @@ class _http_logger:
                   number_of_threads,
                   maxByteLength,
                   debug,
+                  pool_size=1,
+                  keep_alive=True,
+                  idle_timeout=50,
+                  compress=False,
+                  compress_level=6,
+                  queue_max_batches=0,
+                  queue_max_bytes=0,
+                  adaptive=False,
+                  min_threads=1,
+                  max_threads=1,
+                  autotune=False,
+                  retry_attempts=0,
+                  retry_base_delay=500,
+                  retry_max_delay=10000,
+                  retry_reserve=0,
+                  remaining_time=None,
+                  spill_dir='',
+                  spill_max_bytes=0,
+                  spill_segment_bytes=0,
+                  use_ack=False,
+                  ack_poll_interval=1000,
+                  ack_timeout=120000,
+                  balance=Constants.HEC_BALANCE_LEAST_OUTSTANDING,
+                  health_check=False,
+                  eject_errors=0,
+                  eject_time=30000,
                   timeout=60.0
                 ):
 
@@ -278,45 +490,188 @@ class _http_logger:
         self.maxByteLength     = maxByteLength
         self.input_type        = 'json'
         self.headers           = {'Authorization':'Splunk '+self.token}
+        self.pool_size         = pool_size
+        self.keep_alive        = keep_alive
+        self.idle_timeout      = idle_timeout
+        self.compress          = compress
+        self.compress_level    = compress_level
+        self.queue_max_batches = queue_max_batches
+        self.queue_max_bytes   = queue_max_bytes
+        self.controller        = None
+        self.tuner             = None
+        self.retry_attempts    = retry_attempts
+        self.retry_base_delay  = retry_base_delay
+        self.retry_max_delay   = retry_max_delay
+        self.retry_reserve     = retry_reserve
+        self.remaining_time    = remaining_time
+        self.tracker           = _DeliveryTracker()
+        self.spill             = None
+        self.replayed          = 0
+        self.replay_dropped    = 0
+        # sources with a batch on disk, and what the replay learns of the sources it sends
+        self.spilledSources    = set()
+        self.replayObjects     = {}
+        self.acker             = None
+        self.ack_missing       = False
+        # the endpoint setting may list several HEC endpoints to spread the batches over
+        self.endpoints         = _EndpointPool(http_event_server, balance, health_check, eject_errors, eject_time / 1000.0, timeout)
+        if spill_dir:
+            try:
+                self.spill = SpillStore(spill_dir, spill_max_bytes, spill_segment_bytes)
+            except OSError as error:
+                self.cw_logger.error('SPILL DIRECTORY UNUSABLE:'+str(error))
+
+        # bytes handed to HEC before and after compression
+        self.stats_lock        = threading.Lock()
+        self.raw_bytes         = 0
+        self.sent_bytes        = 0
+        self.retried           = 0
+        self.abandoned         = 0
+
+        if not self.keep_alive:
+            self.headers['Connection'] = 'close'
+        if self.compress:
+            self.headers['Content-Encoding'] = 'gzip'
 
         if self.debug:
             self.cw_logger.debug('Token is:'+self.token)
             self.cw_logger.debug('URI is:'+self.server_uri)
             self.cw_logger.debug('Input Type:'+self.input_type)
 
-        requests.packages.urllib3.disable_warnings()
+        _loadRequests()
+
+        if adaptive:
+            # start all the threads the controller may ever use; it decides how many post at once,
+            # starting from the requested number
+            self.controller = _ConcurrencyController(number_of_threads, min_threads, max_threads, lambda: self.flushQueue.qsize())
+            self.number_of_threads = max_threads
+
+        if use_ack:
+            # posted batches wait here until the indexers confirm them, while the senders go on;
+            # built before the senders, so each of them gets a channel
+            self.acker = _AckPoller(self, ack_poll_interval / 1000.0, ack_timeout / 1000.0)
+
         # build the Queue and the threads
         self._buildThreads()
 
+        # failed batches wait out their backoff here, away from the flush queue
+        self.retryQueue = _RetryQueue(self.flushQueue)
+        self.retryQueue.start()
+
+        if self.acker is not None:
+            self.acker.start()
+
+        self.endpoints.start()
+
+        if autotune:
+            with session_lock:
+                if self.server_uri not in batch_tuners:
+                    batch_tuners[self.server_uri] = _BatchSizeTuner(self.maxByteLength)
+                self.tuner = batch_tuners[self.server_uri]
+
+
+    def _getSession(self, slot, uri):
+        # reuse the session this sender slot left behind for the endpoint, unless it sat idle long
+        # enough for HEC or a load balancer in front of it to have dropped the connection
+        key = (uri, slot)
+        now = time.time()
+        with session_lock:
+            entry = hec_sessions.get(key)
+            if entry is not None and ( not self.keep_alive or (now - entry[1]) > self.idle_timeout ):
+                entry[0].close()
+                entry = None
+            if entry is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                entry = [session, now]
+                hec_sessions[key] = entry
+        return entry
+
+    def _batchThread(self, slot):
+        headers = self.headers
+        channel = None
+        if self.acker is not None:
+            # every sender posts on its own channel, acks are tracked per channel
+            channel = self.acker.channelFor(slot)
+            headers = dict(self.headers)
+            headers[Constants.HEC_CHANNEL_HEADER] = channel
 
-    def _batchThread(self):
         while True:
+            # wait for a sending slot before taking work, so idle threads leave batches queued
+            if self.controller is not None and not self.controller.acquire():
+                break
             item = self.flushQueue.get()
             if item is None:
+                if self.controller is not None:
+                    self.controller.release()
                 break
+            elif self._pastDeadline() and self._spillBatch(item):
+                # too late to post it, the batch waits on disk for the next invocation instead;
+                # its objects aren't confirmed, so they stay in S3
+                if self.controller is not None:
+                    self.controller.release()
+                if not item.replay:
+                    self.tracker.done(item.sources, False)
+                self.flushQueue.task_done()
             else:
-                payload = ' '.join(item)
+                payload = self._encodePayload(item.events)
                 if self.debug:
                     self.cw_logger.debug('Thread Called:'+threading.currentThread().name+'. Getting from Queue')
                     self.cw_logger.debug('Events received on thread:'+threading.currentThread().name+'. Sending to Splunk.')
-                self._sendToSplunk(payload)
+                endpoint = self.endpoints.choose()
+                entry = self._getSession(slot, endpoint.uri)
+                started = time.time()
+                failure, ack_id = self._sendToSplunk(entry[0], payload, headers, endpoint.uri)
+                # only this thread uses the slot, so no lock needed to mark it used
+                entry[1] = time.time()
+                self.endpoints.finish(endpoint, entry[1] - started, len(payload), failure is None)
+                if self.controller is not None:
+                    self.controller.release(entry[1] - started, failure is None)
+                if failure is None:
+                    if self.tuner is not None:
+                        self.tuner.record(item.limit, len(item.events), entry[1] - started)
+                    if ack_id is not None:
+                        # accepted but not indexed yet; the poller finishes the batch off
+                        self.flushQueue.hold()
+                        self.acker.add(endpoint.uri, channel, ack_id, item)
+                    else:
+                        self._delivered(item)
+                else:
+                    self._handleFailure(item, failure)
                 self.flushQueue.task_done()
 
 
-    def _sendToSplunk(self,payload):
+    def _encodePayload(self, events):
+        payload = b' '.join(events)
+        raw_length = len(payload)
+        if self.compress:
+            # wbits 31 writes a gzip header and trailer
+            compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, 31)
+            payload = compressor.compress(payload) + compressor.flush()
+        with self.stats_lock:
+            self.raw_bytes += raw_length
+            self.sent_bytes += len(payload)
+        return payload
+
+    def _getByteCounts(self):
+        with self.stats_lock:
+            return (self.raw_bytes, self.sent_bytes)
+
+    # Posts one payload. Returns (failure, ackId): failure is None once HEC has accepted the payload,
+    # otherwise the error message and whether trying again could help. ackId is only set with useACK
+    def _sendToSplunk(self, session, payload, headers=None, uri=None):
          try:
-            r = requests.post(self.server_uri, data=payload, headers=self.headers, verify=False, timeout=self.timeout)
+            r = session.post(uri or self.server_uri, data=payload, headers=headers or self.headers, verify=False, timeout=self.timeout)
          except ( requests.exceptions.Timeout,
                   requests.exceptions.ConnectionError,
                   requests.exceptions.RequestException )  as error:
                 # Send back Timeout
                 # Bad connectivity:DNS, Network
                 # General catch for errors
-                with error_lock:
-                    self.cw_logger.error('CONNECTION ERROR:'+str(error))
-                    self.error[Constants.COUNT] += 1
-                    self.error[Constants.MSG] = {Constants.REASON : str(error) }
-                return
+                self.cw_logger.error('CONNECTION ERROR:'+str(error))
+                return (({Constants.REASON : str(error) }, True), None)
          else:
              # to see if we got a bad return code we first raise that error
              # then capture it in the except
@@ -325,23 +680,154 @@ class _http_logger:
              except requests.exceptions.HTTPError  as error:
                  # General catch for any non 200 return
                  self.cw_logger.error('HTTP ERROR:'+str(error))
-                 with error_lock:
-                     self.error[Constants.COUNT] += 1
-                     self.error[Constants.MSG] = json.loads(r.text)
-                     self.error[Constants.MSG][Constants.REASON] = str(error)
-                 return
+                 try:
+                     message = JsonCodec.loads(r.text)
+                 except ValueError:
+                     # not every proxy in front of HEC answers in JSON
+                     message = {Constants.TXT : r.text}
+                 message[Constants.REASON] = str(error)
+                 # throttling and server side trouble may clear up, a rejected request won't
+                 return ((message, r.status_code in Constants.HEC_RETRY_STATUS or r.status_code >= 500), None)
              else:
                  # Everything is fine, send to cw if in debug mode
                  if self.debug:
                     self.cw_logger.error('HTTP Error Code:'+str(r.status_code)+' TEXT:'+r.text)
-                 return
+                 if self.acker is None:
+                     return (None, None)
+                 try:
+                     ack_id = JsonCodec.loads(r.text).get(Constants.HEC_ACK_ID)
+                 except ValueError:
+                     ack_id = None
+                 if ack_id is None and not self.ack_missing:
+                     # the token doesn't have indexer acknowledgment turned on, go by the 200
+                     self.ack_missing = True
+                     self.cw_logger.error('HEC RETURNED NO ackId, IS INDEXER ACKNOWLEDGMENT ON FOR THE TOKEN?')
+                 return (None, ack_id)
+
+    def _handleFailure(self, batch, failure):
+        message, retryable = failure
+        batch.attempts += 1
+
+        if retryable and batch.attempts <= self.retry_attempts:
+            # full jitter exponential backoff
+            delay = random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * (2 ** (batch.attempts - 1)))) / 1000.0
+
+            # only retry if the post can still finish, worst case, with the reserve left over
+            if self.remaining_time is None or \
+                    ( (delay + self.timeout) * 1000 + self.retry_reserve ) < self.remaining_time():
+                self.flushQueue.hold()
+                self.retryQueue.add(time.time() + delay, batch)
+                with self.stats_lock:
+                    self.retried += 1
+                return
+
+        # a rejected batch would be rejected again, only one HEC couldn't take now is spilled
+        spilled = retryable and self._spillBatch(batch)
+
+        if batch.replay:
+            # a batch from the spill doesn't hold up the new work: it waits for the next replay,
+            # or is dropped when HEC rejected it
+            if not spilled:
+                with self.stats_lock:
+                    self.replay_dropped += 1
+                self.cw_logger.error('DROPPED SPILLED BATCH:' + str(message))
+            return
+
+        # out of attempts or out of time: HEC is in trouble, so stop taking on work either way
+        with error_lock:
+            self.error[Constants.COUNT] += 1
+            self.error[Constants.MSG] = message
+
+        if not spilled:
+            with self.stats_lock:
+                self.abandoned += 1
+        # spilled or not, the objects weren't confirmed and stay in S3 to be sent again
+        self.tracker.done(batch.sources, False)
+
+    # True once the remaining run time is down to the reserve, too late to start a post
+    def _pastDeadline(self):
+        return self.remaining_time is not None and self.remaining_time() < self.retry_reserve
+
+    # A batch HEC confirmed; one replayed from the spill confirms its runs of records
+    def _delivered(self, batch):
+        if not batch.replay:
+            self.tracker.done(batch.sources, True)
+            return
+        with self.stats_lock:
+            for source, (first, last) in batch.sources.items():
+                self.replayObjects[source].confirm(first, last)
+
+    # Keeps a batch on disk for a later invocation, with the runs of records it holds of each
+    # source; returns False without a spill store or room in it
+    def _spillBatch(self, batch):
+        if self.spill is None:
+            return False
+        sources = {source: span for source, span in (batch.sources or {}).items() if span[0] is not None}
+        if not self.spill.write({SpillStore.SOURCES: sources}, b' '.join(batch.events)):
+            return False
+        with self.stats_lock:
+            self.spilledSources.update(sources)
+        return True
+
+    def _noteSource(self, source, records, event_ids):
+        with self.stats_lock:
+            if source not in self.spilledSources:
+                return False
+        return self._writeNote(source, SpilledObject(records, self.tracker.confirmed(source), event_ids))
+
+    # only the eventIDs of the records not confirmed yet are of use to the replay
+    def _writeNote(self, source, spilled):
+        return self.spill.write({SpillStore.OBJECT: source,
+                                 SpillStore.RECORDS: spilled.records,
+                                 SpillStore.CONFIRMED: spilled.confirmedRuns(),
+                                 SpillStore.IDS: spilled.unconfirmedIds()})
+
+    def _replaySpill(self):
+        if self.spill is None:
+            return 0, {}
+        replayed = 0
+        for segment in self.spill.claim():
+            for head, body in self.spill.read(segment):
+                if SpillStore.OBJECT in head:
+                    with self.stats_lock:
+                        self._replayObject(head[SpillStore.OBJECT]).note(head)
+                    continue
+                sources = head.get(SpillStore.SOURCES) or {}
+                with self.stats_lock:
+                    for source in sources:
+                        self._replayObject(source)
+                # a body is a whole post already, it goes out as a batch of one
+                self._sendEvent([body], sources=sources, replay=True)
+                replayed += 1
+            # whatever HEC can't take now is spilled to a new segment, rejected bodies are dropped
+            self._waitForQueue()
+            self.spill.remove(segment)
+
+        with self.stats_lock:
+            self.replayed += replayed
+            objects = self.replayObjects
+            self.replayObjects = {}
+            for source, spilled in objects.items():
+                spilled.pending = source in self.spilledSources
+        # an object with batches on disk again keeps its note for the next replay
+        for source, spilled in objects.items():
+            if spilled.pending:
+                self._writeNote(source, spilled)
+        return replayed, objects
+
+    # the caller holds stats_lock
+    def _replayObject(self, source):
+        spilled = self.replayObjects.get(source)
+        if spilled is None:
+            spilled = self.replayObjects[source] = SpilledObject()
+        return spilled
 
     def kill(self):
         del self
 
     def _buildThreads(self):
-        # set up the Queue
-        self.flushQueue = Queue.Queue(0)
+        # set up the Queue, bounded so producers wait when HEC falls behind
+        self.flushQueue = _FlushQueue(self.queue_max_batches, self.queue_max_bytes)
 
         # keep count of how many we build
         threadcount = 0
@@ -352,7 +838,7 @@ class _http_logger:
             self.cw_logger.debug('Total threads on container is:'+str(len(threading.enumerate())))
         for x in range(self.number_of_threads):
             for y in range(retries):
-                t = threading.Thread(target=self._batchThread)
+                t = threading.Thread(target=self._batchThread, args=(x,))
                 t.daemon = True
                 try:
                     t.start()
@@ -371,6 +857,8 @@ class _http_logger:
                     threadcount += 1
                     break
 
+        self.threadcount = threadcount
+
         if( threadcount > 0):
             if self.debug:
                 self.cw_logger.debug('Started:'+str(threadcount)+' threads out of the:'+str(self.number_of_threads)+' requested.')
@@ -382,13 +870,610 @@ class _http_logger:
             self.error[Constants.MSG] = {Constants.REASON : 'Cant Start Any Threads' }
 
 
+    def _waitForQueue(self):
+        # block until every batch queued so far has been handled, retries included
+        self.flushQueue.join()
+
+    def _waitForSource(self, source):
+        return self.tracker.wait(source)
+
     def _waitUntilDone(self):
-        # make sure all threads are done
+        # make sure all threads are done, and every ack is in
         self.flushQueue.join()
+        if self.acker is not None:
+            self.acker.close()
+        self.endpoints.close()
         # send signal to kill the queues
-        for i in range(self.number_of_threads):
+        for i in range(self.threadcount):
             self.flushQueue.put(None)
+        # threads still waiting for a sending slot won't see the signal
+        if self.controller is not None:
+            self.controller.close()
+        self.retryQueue.close()
         return
 
-    def _sendEvent(self, event):
-        self.flushQueue.put(event)
+    def _getQueueFields(self):
+        return ['QueueHighWaterBatches=%d' % self.flushQueue.high_water_batches,
+                'QueueHighWaterBytes=%d' % self.flushQueue.high_water_bytes,
+                'ProducerWait_ms=%d' % int(self.flushQueue.wait_time * 1000)]
+
+    def _getConcurrencyFields(self):
+        if self.controller is None:
+            return ['HecThreads=%d' % self.threadcount]
+        return self.controller.getFields()
+
+    def _getBatchLimit(self):
+        if self.tuner is None:
+            return self.maxByteLength
+        return self.tuner.size
+
+    def _getBatchFields(self):
+        if self.tuner is None:
+            return ['BatchMaxBytes=%d' % self.maxByteLength]
+        return self.tuner.getFields()
+
+    def _getAckFields(self):
+        if self.acker is None:
+            return []
+        return self.acker.getFields()
+
+    def _getSpillFields(self):
+        if self.spill is None:
+            return []
+        with self.stats_lock:
+            replayed = self.replayed
+            replay_dropped = self.replay_dropped
+        return ['SpillReplayed=%d' % replayed, 'SpillReplayDropped=%d' % replay_dropped] + self.spill.getFields()
+
+    def _getRetryFields(self):
+        with self.stats_lock:
+            return ['HecRetries=%d' % self.retried,
+                    'HecAbandoned=%d' % self.abandoned]
+
+    def _sendEvent(self, event, size=None, limit=None, sources=None, replay=False):
+        if size is None:
+            size = sum(len(e) + 1 for e in event)
+        # no object worker waits on a replayed batch
+        if not replay:
+            self.tracker.add(sources)
+        self.flushQueue.put(_Batch(event, size, limit, sources, replay), size)
+
+
+class _Batch:
+    # The events of one HEC post, with their size in bytes, the byte limit they were built under,
+    # the S3 objects they came from, whether it was read back from the spill and how many times
+    # the post has failed
+
+    __slots__ = ('events', 'size', 'limit', 'sources', 'replay', 'attempts')
+
+    def __init__(self, events, size, limit=None, sources=None, replay=False):
+        self.events   = events
+        self.size     = size
+        self.limit    = limit
+        self.sources  = sources
+        self.replay   = replay
+        self.attempts = 0
+
+
+class _DeliveryTracker:
+    # Counts the batches still outstanding for each source object, remembers the
+    # sources that had a batch given up on, and how many leading records of each
+    # source were confirmed without a gap
+
+    def __init__(self):
+        self.pending   = {}
+        self.failed    = set()
+        self.marks     = {}
+        self.runs      = {}
+        self.condition = threading.Condition()
+
+    def start(self, source, records=0):
+        with self.condition:
+            self.marks[source] = records
+            self.runs[source] = []
+
+    def watermark(self, source):
+        with self.condition:
+            return self.marks.get(source, 0)
+
+    def add(self, sources):
+        if not sources:
+            return
+        with self.condition:
+            for source in sources:
+                self.pending[source] = self.pending.get(source, 0) + 1
+
+    def done(self, sources, delivered):
+        if not sources:
+            return
+        with self.condition:
+            for source in sources:
+                self.pending[source] -= 1
+                if not delivered:
+                    self.failed.add(source)
+                elif source in self.runs and sources[source][0] is not None:
+                    self._confirm(source, sources[source])
+            self.condition.notify_all()
+
+    # batches finish out of order; move the mark over every run that now joins up with it
+    def _confirm(self, source, span):
+        runs = self.runs[source]
+        heapq.heappush(runs, (span[0], span[1]))
+        while runs and runs[0][0] <= self.marks[source] + 1:
+            first, last = heapq.heappop(runs)
+            self.marks[source] = max(self.marks[source], last)
+
+    # Returns the runs of records of the source confirmed so far, the leading one first
+    def confirmed(self, source):
+        with self.condition:
+            mark = self.marks.get(source, 0)
+            return ([[1, mark]] if mark else []) + sorted([first, last] for first, last in self.runs.get(source, []))
+
+    def wait(self, source):
+        with self.condition:
+            while self.pending.get(source, 0) > 0:
+                self.condition.wait()
+            self.pending.pop(source, None)
+            if source in self.failed:
+                self.failed.discard(source)
+                return False
+            return True
+
+
+class _AckPoller:
+    # Collects the ackIds HEC hands out per endpoint and channel and asks the endpoint's ack
+    # URI about them in bulk, every interval, on its own thread. A confirmed batch is delivered; one that stays
+    # unconfirmed past the ack timeout, or the deadline, goes the way of a failed post.
+
+    def __init__(self, sender, interval, ack_timeout):
+        self.sender      = sender
+        self.interval    = interval
+        self.ack_timeout = ack_timeout
+        self.channels    = {}
+        self.pending     = {}
+        self.closed      = False
+        self.condition   = threading.Condition()
+        self.acked       = 0
+        self.timeouts    = 0
+        self.polls       = 0
+
+    def start(self):
+        t = threading.Thread(target=self._run)
+        t.daemon = True
+        t.start()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def channelFor(self, slot):
+        with self.condition:
+            if slot not in self.channels:
+                self.channels[slot] = str(uuid.uuid4())
+            return self.channels[slot]
+
+    # ackIds only mean something to the endpoint and channel that handed them out
+    def add(self, uri, channel, ack_id, batch):
+        with self.condition:
+            self.pending.setdefault((uri, channel), {})[ack_id] = (batch, time.time())
+
+    def _run(self):
+        session = requests.Session()
+        while True:
+            with self.condition:
+                if not self.closed:
+                    self.condition.wait(self.interval)
+                if self.closed:
+                    session.close()
+                    return
+                waiting = [(target, list(acks)) for target, acks in self.pending.items() if acks]
+
+            for target, ack_ids in waiting:
+                for i in range(0, len(ack_ids), Constants.HEC_ACK_POLL_MAX):
+                    for ack_id in self._poll(session, target, ack_ids[i:i + Constants.HEC_ACK_POLL_MAX]):
+                        self._resolve(target, ack_id, True)
+
+            # what is still waiting after its timeout, or when time is up, counts as not delivered
+            now = time.time()
+            deadline = self.sender._pastDeadline()
+            with self.condition:
+                expired = [(target, ack_id) for target, acks in self.pending.items()
+                           for ack_id, (batch, posted) in acks.items()
+                           if deadline or now - posted > self.ack_timeout]
+            for target, ack_id in expired:
+                self._resolve(target, ack_id, False)
+
+    # Returns the ackIds of the list the indexers have confirmed
+    def _poll(self, session, target, ack_ids):
+        uri, channel = target
+        headers = {'Authorization': self.sender.headers['Authorization'],
+                   Constants.HEC_CHANNEL_HEADER: channel}
+        try:
+            r = session.post(_serviceUri(uri, Constants.HEC_ACK_PATH), data=JsonCodec.dumpb({Constants.HEC_ACKS: ack_ids}), headers=headers,
+                             verify=False, timeout=self.sender.timeout)
+            r.raise_for_status()
+            acks = JsonCodec.loads(r.text).get(Constants.HEC_ACKS, {})
+        except (requests.exceptions.RequestException, ValueError) as error:
+            # unanswered acks are asked about again next time, until they time out
+            self.sender.cw_logger.error('ACK POLL ERROR:'+str(error))
+            return []
+        with self.condition:
+            self.polls += 1
+        return [int(ack_id) for ack_id, confirmed in acks.items() if confirmed]
+
+    def _resolve(self, target, ack_id, delivered):
+        with self.condition:
+            entry = self.pending[target].pop(ack_id, None)
+            if entry is None:
+                return
+            if delivered:
+                self.acked += 1
+            else:
+                self.timeouts += 1
+        batch = entry[0]
+        if delivered:
+            self.sender._delivered(batch)
+        else:
+            self.sender._handleFailure(batch, ({Constants.REASON: 'ackId %d not confirmed in time' % ack_id}, True))
+        # releases the hold taken when the batch was posted
+        self.sender.flushQueue.task_done()
+
+    def getFields(self):
+        with self.condition:
+            return ['HecAcked=%d' % self.acked,
+                    'HecAckTimeouts=%d' % self.timeouts,
+                    'HecAckPolls=%d' % self.polls]
+
+
+# Returns the URI of another HEC service on the host of an endpoint
+def _serviceUri(uri, path):
+    result = urlparse.urlparse(uri)
+    return result.scheme + '://' + result.netloc + path
+
+
+class _Endpoint:
+    # One HEC endpoint with its weight, load and counters
+
+    def __init__(self, uri, weight):
+        self.uri            = uri
+        self.weight         = weight
+        self.current        = 0
+        self.outstanding    = 0
+        self.failures       = 0
+        self.ejected_until  = 0
+        self.checking       = False
+        self.posts          = 0
+        self.errors         = 0
+        self.ejections      = 0
+        self.bytes          = 0
+        self.latency        = 0.0
+
+
+class _EndpointPool:
+    # Spreads the posts over the HEC endpoints listed in the endpoint setting (comma separated,
+    # each optionally followed by |weight), by least outstanding requests per weight or smooth
+    # weighted round robin. An endpoint failing eject_errors posts in a row is left out for
+    # eject_time; with health checks it only comes back once /services/collector/health says so.
+
+    def __init__(self, setting, balance, health_check, eject_errors, eject_time, timeout):
+        self.endpoints = []
+        for item in setting.split(Constants.HEC_ENDPOINT_SEPARATOR):
+            uri, _, weight = item.strip().partition(Constants.HEC_WEIGHT_SEPARATOR)
+            if uri:
+                self.endpoints.append(_Endpoint(uri, max(1, int(weight)) if weight.strip() else 1))
+        self.balance      = balance
+        self.health_check = health_check
+        self.eject_errors = eject_errors
+        self.eject_time   = eject_time
+        self.timeout      = timeout
+        self.closed       = False
+        self.lock         = threading.Lock()
+
+    # With health checks on, every endpoint is looked at in the background before it is trusted
+    def start(self):
+        if self.health_check and len(self.endpoints) > 1:
+            for endpoint in self.endpoints:
+                self._startCheck(endpoint)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+
+    def choose(self):
+        now = time.time()
+        with self.lock:
+            healthy = [e for e in self.endpoints if e.ejected_until <= now and not e.checking]
+            for e in self.endpoints:
+                # an ejection has run out, check the endpoint before sending to it again
+                if e.ejected_until and e.ejected_until <= now and self.health_check and not e.checking:
+                    self._startCheck(e)
+            # with every endpoint out, keep going with all of them rather than stall
+            candidates = healthy or self.endpoints
+
+            if self.balance == Constants.HEC_BALANCE_WEIGHTED_ROUND_ROBIN:
+                total = 0
+                for e in candidates:
+                    e.current += e.weight
+                    total += e.weight
+                endpoint = max(candidates, key=lambda e: e.current)
+                endpoint.current -= total
+            else:
+                endpoint = min(candidates, key=lambda e: e.outstanding / e.weight)
+            endpoint.outstanding += 1
+            return endpoint
+
+    def finish(self, endpoint, latency, size, delivered):
+        with self.lock:
+            endpoint.outstanding -= 1
+            endpoint.posts += 1
+            endpoint.latency += latency
+            if delivered:
+                endpoint.bytes += size
+                endpoint.failures = 0
+                endpoint.ejected_until = 0
+                return
+            endpoint.errors += 1
+            endpoint.failures += 1
+            if self.eject_errors > 0 and endpoint.failures >= self.eject_errors and len(self.endpoints) > 1:
+                endpoint.ejected_until = time.time() + self.eject_time
+                endpoint.failures = 0
+                endpoint.ejections += 1
+
+    # the caller holds the lock
+    def _startCheck(self, endpoint):
+        endpoint.checking = True
+        t = threading.Thread(target=self._check, args=(endpoint,))
+        t.daemon = True
+        t.start()
+
+    def _check(self, endpoint):
+        try:
+            r = requests.get(_serviceUri(endpoint.uri, Constants.HEC_HEALTH_PATH), verify=False, timeout=self.timeout)
+            healthy = r.status_code == 200
+        except requests.exceptions.RequestException:
+            healthy = False
+        with self.lock:
+            endpoint.checking = False
+            if healthy:
+                endpoint.ejected_until = 0
+            elif not self.closed:
+                if not endpoint.ejected_until:
+                    endpoint.ejections += 1
+                endpoint.ejected_until = time.time() + self.eject_time
+
+    def getFields(self):
+        fields = []
+        with self.lock:
+            for i, e in enumerate(self.endpoints, 1):
+                fields.extend(['Hec%dEndpoint=%s' % (i, urlparse.urlparse(e.uri).netloc),
+                               'Hec%dPosts=%d' % (i, e.posts),
+                               'Hec%dErrors=%d' % (i, e.errors),
+                               'Hec%dLatency_ms=%d' % (i, e.latency * 1000 / e.posts if e.posts else 0),
+                               'Hec%dBytes=%d' % (i, e.bytes),
+                               'Hec%dEjections=%d' % (i, e.ejections)])
+        return fields
+
+
+class _RetryQueue:
+    # Holds failed batches until their backoff has passed, then puts them back on the flush
+    # queue. The flush queue keeps counting them as unfinished meanwhile, so join() waits for them.
+
+    def __init__(self, flushQueue):
+        self.flushQueue = flushQueue
+        self.heap       = []
+        self.sequence   = 0
+        self.closed     = False
+        self.condition  = threading.Condition()
+
+    def start(self):
+        t = threading.Thread(target=self._run)
+        t.daemon = True
+        t.start()
+
+    def add(self, due, batch):
+        with self.condition:
+            self.sequence += 1
+            heapq.heappush(self.heap, (due, self.sequence, batch))
+            self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.closed:
+                    if not self.heap:
+                        self.condition.wait()
+                        continue
+                    wait_for = self.heap[0][0] - time.time()
+                    if wait_for <= 0:
+                        break
+                    self.condition.wait(wait_for)
+                if self.closed:
+                    return
+                due, sequence, batch = heapq.heappop(self.heap)
+            self.flushQueue.put(batch, batch.size, held=True)
+
+
+class _BatchSizeTuner:
+    # Searches for the batch byte limit giving the most events per second per post. Each size
+    # is measured over a few posts; the search doubles while that improves, then halves from
+    # the best size seen, and settles once neither neighbour of the best size does better.
+
+    def __init__(self, initial, minimum=Constants.HEC_BATCH_TUNE_MIN, maximum=Constants.HEC_BATCH_TUNE_MAX):
+        self.minimum   = minimum
+        self.maximum   = maximum
+        self.size      = min(max(initial, minimum), maximum)
+        self.factor    = 2.0
+        self.settled   = False
+        self.results   = {}
+        self.lock      = threading.Lock()
+        self._resetWindow()
+
+    def _resetWindow(self):
+        self.posts   = 0
+        self.events  = 0
+        self.latency = 0.0
+
+    def record(self, limit, events, latency):
+        with self.lock:
+            # batches built under an earlier limit say nothing about the current one
+            if self.settled or limit != self.size:
+                return
+            self.posts   += 1
+            self.events  += events
+            self.latency += latency
+            if self.posts >= Constants.HEC_BATCH_TUNE_SAMPLES and self.latency > 0:
+                self.results[self.size] = self.events / self.latency
+                self._next()
+
+    def _next(self):
+        best = max(self.results, key=self.results.get)
+        for factor in (self.factor, 0.5):
+            candidate = int(best * factor)
+            if self.minimum <= candidate <= self.maximum and candidate not in self.results:
+                self.factor = factor
+                self.size   = candidate
+                self._resetWindow()
+                return
+        self.size    = best
+        self.settled = True
+
+    def getFields(self):
+        with self.lock:
+            return ['BatchMaxBytes=%d' % self.size,
+                    'BatchAutoTune=%s' % ('settled' if self.settled else 'searching')]
+
+
+class _ConcurrencyController:
+    # AIMD limit on how many sender threads post to HEC at once. Measured every window of
+    # 'limit' posts: any error halves the limit, an average latency well above the best seen
+    # so far takes a quarter off, and otherwise the limit grows by one while batches are queued.
+
+    def __init__(self, initial, minimum, maximum, backlog):
+        self.minimum      = max(1, minimum)
+        self.maximum      = max(self.minimum, maximum)
+        self.limit        = min(max(initial, self.minimum), self.maximum)
+        self.peak         = self.limit
+        self.backlog      = backlog
+        self.active       = 0
+        self.closed       = False
+        self.condition    = threading.Condition()
+
+        # current measurement window
+        self.posts        = 0
+        self.errors       = 0
+        self.latency      = 0.0
+
+        # best window latency seen, drifts up slowly so a busy indexer is not punished forever
+        self.baseline     = None
+        self.total_posts  = 0
+        self.total_errors = 0
+
+    def acquire(self):
+        with self.condition:
+            while not self.closed and self.active >= self.limit:
+                self.condition.wait()
+            if self.closed:
+                return False
+            self.active += 1
+            return True
+
+    def release(self, latency=None, delivered=True):
+        with self.condition:
+            self.active -= 1
+            if latency is not None:
+                self.posts += 1
+                self.total_posts += 1
+                if delivered:
+                    self.latency += latency
+                else:
+                    self.errors += 1
+                    self.total_errors += 1
+                if self.posts >= self.limit:
+                    self._adjust()
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def _adjust(self):
+        delivered = self.posts - self.errors
+        average = (self.latency / delivered) if delivered else None
+
+        if average is not None:
+            if self.baseline is None or average < self.baseline:
+                self.baseline = average
+            else:
+                self.baseline += (average - self.baseline) * Constants.HEC_BASELINE_DRIFT
+
+        if self.errors:
+            self.limit = max(self.minimum, int(self.limit * Constants.HEC_ERROR_DECREASE))
+        elif average is not None and average > self.baseline * Constants.HEC_LATENCY_TOLERANCE:
+            self.limit = max(self.minimum, self.limit - max(1, self.limit // 4))
+        elif self.backlog() > 0:
+            self.limit = min(self.maximum, self.limit + 1)
+
+        self.peak    = max(self.peak, self.limit)
+        self.posts   = 0
+        self.errors  = 0
+        self.latency = 0.0
+
+    def getFields(self):
+        with self.condition:
+            return ['HecThreads=%d' % self.limit,
+                    'HecThreadsPeak=%d' % self.peak,
+                    'HecPosts=%d' % self.total_posts,
+                    'HecErrors=%d' % self.total_errors]
+
+
+class _FlushQueue(Queue.Queue):
+    # A FIFO bounded both by the number of batches and by their total size. put() blocks
+    # while either bound is reached; the deepest the queue got and the total time producers
+    # spent waiting are kept so memory and thread counts can be sized from real runs.
+
+    def __init__(self, max_batches=0, max_bytes=0):
+        Queue.Queue.__init__(self, max_batches)
+        self.max_bytes          = max_bytes
+        self.bytes              = 0
+        self.high_water_batches = 0
+        self.high_water_bytes   = 0
+        self.wait_time          = 0.0
+
+    # 'held' puts were already counted as unfinished through hold()
+    def put(self, item, size=0, held=False):
+        with self.not_full:
+            if self._isFull(size):
+                waited = time.time()
+                while self._isFull(size):
+                    self.not_full.wait()
+                self.wait_time += time.time() - waited
+            self._put((item, size))
+            self.bytes += size
+            if not held:
+                self.unfinished_tasks += 1
+            self.high_water_batches = max(self.high_water_batches, self._qsize())
+            self.high_water_bytes = max(self.high_water_bytes, self.bytes)
+            self.not_empty.notify()
+
+    # Keeps join() waiting for an item that is out of the queue but will be put back
+    def hold(self):
+        with self.mutex:
+            self.unfinished_tasks += 1
+
+    def _isFull(self, size):
+        if self.maxsize > 0 and self._qsize() >= self.maxsize:
+            return True
+        # a batch larger than the byte bound still goes through once the queue is empty
+        return self.max_bytes > 0 and self.bytes > 0 and (self.bytes + size) > self.max_bytes
+
+    def _get(self):
+        item, size = self.queue.popleft()
+        self.bytes -= size
+        return item
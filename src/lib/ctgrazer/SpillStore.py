@@ -0,0 +1,207 @@
+"""
+Description: On-disk buffer for HEC batches that could not be delivered. Entries are framed
+(4 byte length + JSON head, 4 byte length + body) into gzip segment files of a capped size
+under a local directory, normally in /tmp, and replayed by a later invocation of the same
+container. A batch's head holds the runs of records it carries of each S3 object; a note,
+with an empty body, tells what became of the rest of an object, so the replay can finish it
+off. /tmp lives only as long as the container does, so a spilled batch is lost if the
+container is recycled first.
+"""
+
+import os
+import bisect
+import gzip
+import struct
+import threading
+import time
+import zlib
+
+from lib.ctgrazer.Constants import Constants
+from lib.ctgrazer.JsonCodec import JsonCodec
+
+
+class SpillStore:
+
+    SEGMENT_SUFFIX = '.spill'
+    REPLAY_SUFFIX = '.replaying'
+    FRAME = struct.Struct('>I')
+
+    # head of a batch: source -> [first, last] record of the source in it
+    SOURCES = 'sources'
+    # head of a note: the source, its number of records (None unless it was read to the end),
+    # the runs of them HEC confirmed and the [record, eventID] of the others
+    OBJECT = 'object'
+    RECORDS = 'records'
+    CONFIRMED = 'confirmed'
+    IDS = 'ids'
+
+    def __init__(self, directory, max_bytes, segment_bytes, level=Constants.SPILL_GZIP_LEVEL):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.level = level
+        self.lock = threading.Lock()
+        self.segment = None
+        self.sequence = 0
+        self.spilled = 0
+        self.dropped = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self.used = sum(os.path.getsize(path) for path in self._files())
+
+    # Appends an entry, a batch body or an empty one for a note; returns False if it didn't fit
+    # under the size cap or couldn't be written
+    def write(self, head, body=b''):
+        head = JsonCodec.dumpb(head)
+        with self.lock:
+            if self.used + len(head) + len(body) > self.max_bytes:
+                if body:
+                    self.dropped += 1
+                return False
+            try:
+                if self.segment is None or os.path.getsize(self.segment) >= self.segment_bytes:
+                    self.sequence += 1
+                    self.segment = os.path.join(self.directory, '%d-%d%s' % (time.time() * 1000, self.sequence, self.SEGMENT_SUFFIX))
+                    before = 0
+                else:
+                    before = os.path.getsize(self.segment)
+                # every write is its own gzip member, so a segment is readable up to the last whole one
+                with gzip.open(self.segment, 'ab', compresslevel=self.level) as f:
+                    f.write(self.FRAME.pack(len(head)))
+                    f.write(head)
+                    f.write(self.FRAME.pack(len(body)))
+                    f.write(body)
+                self.used += os.path.getsize(self.segment) - before
+            except OSError as error:
+                print('[WARNING] Unable to spill batch to {}: {}'.format(self.directory, error))
+                if body:
+                    self.dropped += 1
+                return False
+            if body:
+                self.spilled += 1
+            return True
+
+    # Takes over the segments written so far for replay, oldest first. Segments left over
+    # from a replay that never finished are taken again.
+    def claim(self):
+        with self.lock:
+            # new spills go to a fresh segment, never to one being replayed
+            self.segment = None
+            claimed = []
+            for path in sorted(self._files()):
+                if path.endswith(self.SEGMENT_SUFFIX):
+                    replaying = path[:-len(self.SEGMENT_SUFFIX)] + self.REPLAY_SUFFIX
+                    os.replace(path, replaying)
+                    path = replaying
+                claimed.append(path)
+            return claimed
+
+    # Yields the (head, body) entries of a claimed segment; a damaged tail ends it early
+    def read(self, path):
+        try:
+            with gzip.open(path, 'rb') as f:
+                while True:
+                    head = self._frame(f)
+                    body = self._frame(f) if head is not None else None
+                    if body is None:
+                        return
+                    yield JsonCodec.loads(head), body
+        except (OSError, EOFError, ValueError, zlib.error) as error:
+            print('[WARNING] Spill segment {} is damaged: {}'.format(path, error))
+
+    # Returns the next framed part of a segment, None when it is cut short
+    def _frame(self, f):
+        head = f.read(self.FRAME.size)
+        if len(head) < self.FRAME.size:
+            return None
+        length = self.FRAME.unpack(head)[0]
+        data = f.read(length)
+        if len(data) < length:
+            return None
+        return data
+
+    def remove(self, path):
+        with self.lock:
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except OSError:
+                return
+            self.used -= size
+
+    def _files(self):
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                if name.endswith(self.SEGMENT_SUFFIX) or name.endswith(self.REPLAY_SUFFIX)]
+
+    def getFields(self):
+        with self.lock:
+            return ['SpillBatches=%d' % self.spilled,
+                    'SpillDropped=%d' % self.dropped,
+                    'SpillBytes=%d' % self.used]
+
+
+class SpilledObject:
+    # What a replay learned of one S3 object from the spill: its number of records, None unless
+    # it was read to the end, the runs of them HEC confirmed, the [record, eventID] of the others
+    # as noted when they were spilled, and whether some of its batches are on disk again
+
+    __slots__ = ('records', 'runs', 'ids', 'pending')
+
+    def __init__(self, records=None, runs=None, ids=None):
+        self.records = records
+        self.runs    = list(runs or [])
+        self.ids     = list(ids or [])
+        self.pending = False
+
+    # Takes in a note; notes from several invocations add up
+    def note(self, head):
+        if head.get(SpillStore.RECORDS) is not None:
+            self.records = head[SpillStore.RECORDS]
+        self.runs.extend(head.get(SpillStore.CONFIRMED) or [])
+        self.ids.extend(head.get(SpillStore.IDS) or [])
+
+    def confirm(self, first, last):
+        self.runs.append([first, last])
+
+    # Returns the confirmed runs, sorted and joined
+    def confirmedRuns(self):
+        return self._merged()
+
+    # Returns how many leading records are confirmed, when the first 'start' of them already are
+    def leading(self, start=0):
+        mark = start
+        for first, last in self._merged():
+            if first > mark + 1:
+                break
+            mark = max(mark, last)
+        return mark
+
+    # True once every record is confirmed and none of the object's batches is left on disk
+    def complete(self, start=0):
+        return not self.pending and self.records is not None and self.leading(start) >= self.records
+
+    # Returns the eventIDs of noted records that are confirmed now
+    def confirmedIds(self):
+        runs = self._merged()
+        return [event_id for record, event_id in self.ids if self._covers(runs, record)]
+
+    # Returns the noted [record, eventID] not confirmed yet
+    def unconfirmedIds(self):
+        runs = self._merged()
+        return [[record, event_id] for record, event_id in self.ids if not self._covers(runs, record)]
+
+    @staticmethod
+    def _covers(runs, record):
+        i = bisect.bisect_right(runs, [record, float('inf')]) - 1
+        return i >= 0 and runs[i][1] >= record
+
+    # the runs sorted and joined where they touch or overlap
+    def _merged(self):
+        merged = []
+        for first, last in sorted(self.runs):
+            if merged and first <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], last)
+            else:
+                merged.append([first, last])
+        self.runs = merged
+        return merged
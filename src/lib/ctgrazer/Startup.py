@@ -0,0 +1,45 @@
+"""
+Description: Loads heavy modules on first use and keeps a profile of what the container
+spent starting up (time per imported module, init steps), reported in the START record of
+the invocation that paid for them.
+"""
+
+import importlib
+import threading
+import time
+
+
+class Startup:
+
+    # name -> milliseconds, in the order they were measured
+    profile = {}
+    modules = {}
+    lock = threading.Lock()
+
+    # Imports a module the first time it is asked for and records how long that took
+    @staticmethod
+    def load(name):
+        module = Startup.modules.get(name)
+        if module is not None:
+            return module
+        with Startup.lock:
+            if name not in Startup.modules:
+                started = time.time()
+                Startup.modules[name] = importlib.import_module(name)
+                Startup.profile['Import_' + name] = (time.time() - started) * 1000
+            return Startup.modules[name]
+
+    # Records a startup step that took place since 'started' (a time.time() value)
+    @staticmethod
+    def record(name, started):
+        with Startup.lock:
+            Startup.profile[name] = (time.time() - started) * 1000
+
+    # Returns the steps recorded since the last call, so a warm START record only shows
+    # what its own invocation loaded, such as a changed config
+    @staticmethod
+    def getFields():
+        with Startup.lock:
+            fields = ['%s_ms=%d' % (name, ms) for name, ms in Startup.profile.items()]
+            Startup.profile.clear()
+            return fields
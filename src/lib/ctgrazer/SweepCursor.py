@@ -0,0 +1,88 @@
+"""
+Description: Remembers, per CloudTrail region prefix, the last key up to which every object
+has been swept, so the next sweep can resume listing with StartAfter. The cursor is kept as
+JSON in an S3 object (s3://bucket/key) or in a local file. Every so many sweeps the marks
+are ignored and the whole prefix is listed again, to catch objects delivered late.
+"""
+
+import os
+
+from lib.ctgrazer.JsonCodec import JsonCodec
+
+
+class SweepCursor:
+
+    S3_SCHEME = 's3://'
+    SWEEPS = 'sweeps'
+    MARKS = 'marks'
+
+    def __init__(self, location, client=None, full_rescan_every=0):
+        self.location = location
+        self.client = client
+        self.full_rescan_every = full_rescan_every
+        self.sweeps = 0
+        self.marks = {}
+        self.full_rescan = True
+
+        if location.startswith(self.S3_SCHEME):
+            self.bucket, _, self.key = location[len(self.S3_SCHEME):].partition('/')
+        else:
+            self.bucket, self.key = None, None
+
+    # Reads the cursor; a missing or unreadable cursor means a full listing
+    def load(self):
+        try:
+            if self.bucket is not None:
+                data = self.client.get_object(Bucket=self.bucket, Key=self.key)['Body'].read()
+            elif os.path.exists(self.location):
+                with open(self.location, 'rb') as f:
+                    data = f.read()
+            else:
+                data = None
+            state = JsonCodec.loads(data) if data else {}
+        except Exception as error:
+            print('[WARNING] Unable to read sweep cursor {}: {}'.format(self.location, error))
+            state = {}
+
+        self.sweeps = state.get(self.SWEEPS, 0)
+        self.marks = state.get(self.MARKS, {})
+        self.full_rescan = not self.marks or \
+            ( self.full_rescan_every > 0 and self.sweeps % self.full_rescan_every == 0 )
+
+    def save(self):
+        data = JsonCodec.dumpb({self.SWEEPS: self.sweeps + 1, self.MARKS: self.marks})
+        if self.bucket is not None:
+            self.client.put_object(Bucket=self.bucket, Key=self.key, Body=data)
+        else:
+            # write aside and swap, so a cursor is never left half written
+            temp = self.location + '.tmp'
+            with open(temp, 'wb') as f:
+                f.write(data)
+            os.replace(temp, self.location)
+
+    # True if 'key' is the cursor itself, which may sit under the swept prefix
+    def isCursor(self, bucket, key):
+        return bucket == self.bucket and key == self.key
+
+    # Returns the key to resume listing the region prefix after, None to list it all
+    def startAfter(self, region):
+        if self.full_rescan:
+            return None
+        return self.marks.get(region)
+
+    # Moves the mark of a region forward through the run of listed keys that have all
+    # been processed. An object left behind stops the run, so the next sweep sees it again.
+    def advance(self, region, listed, processed):
+        mark = None
+        for key in sorted(listed):
+            if key not in processed:
+                break
+            mark = key
+        old = self.marks.get(region)
+        # a full rescan must not move the mark back over stragglers it couldn't handle
+        if mark is not None and ( old is None or mark > old ):
+            self.marks[region] = mark
+
+    def getFields(self):
+        return ['SweepCursorRegions=%d' % len(self.marks),
+                'SweepFullRescan=%s' % self.full_rescan]
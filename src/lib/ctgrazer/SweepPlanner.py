@@ -0,0 +1,150 @@
+"""
+Description: Plans the scheduled sweep from S3 listings alone. The age filter uses the
+LastModified returned by ListObjectsV2, and the CloudTrail key layout
+(AWSLogs/<acct>/CloudTrail/<region>/YYYY/MM/DD/) is used to skip date partitions that
+can't hold objects old enough to be picked up. Prefixes of one level are listed in parallel.
+With a SweepCursor, a region prefix is listed flat from the key it was last swept up to.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from lib.ctgrazer.Constants import Constants
+
+
+class SweepPlanner:
+
+    DELIMITER = '/'
+
+    def __init__(self, client, bucket, workers=1, cursor=None):
+        self.client = client
+        self.bucket = bucket
+        self.workers = max(1, workers)
+        self.cursor = cursor
+        # every key listed under each region prefix, for moving the cursor on afterwards
+        self.listed = {}
+        self.lock = threading.Lock()
+        self.list_calls = 0
+        self.skipped_partitions = 0
+
+    # Returns the listing entries (Key, LastModified, Size) under prefix last modified at
+    # or before cutoff, in key order
+    def plan(self, prefix, cutoff):
+        found = []
+        # breadth first: every prefix of a level is listed at once, so accounts and
+        # regions are walked side by side
+        level = [prefix]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while level:
+                next_level = []
+                for contents, prefixes in pool.map(lambda p: self._listLevel(p, cutoff), level):
+                    found.extend(c for c in contents if c['LastModified'] <= cutoff)
+                    next_level.extend(prefixes)
+                level = next_level
+
+        found.sort(key=lambda c: c['Key'])
+        return found
+
+    # Returns the objects and the sub prefixes worth walking directly under prefix
+    def _listLevel(self, prefix, cutoff):
+        date = self._partitionDate(prefix)
+        if date is not None and len(date) == 3:
+            # a day partition holds only objects, list all of them without the delimiter
+            contents, prefixes = self._list(prefix, None)
+            return self._track(contents), []
+
+        if self.cursor is not None and self._isRegion(prefix):
+            start_after = self.cursor.startAfter(prefix)
+            if start_after is not None:
+                # keys sort by date below the region, so everything new comes after the mark
+                contents, prefixes = self._list(prefix, None, start_after)
+                return self._track(contents), []
+
+        contents, prefixes = self._list(prefix, self.DELIMITER)
+        walk = []
+        for sub in prefixes:
+            start = self._partitionStart(sub)
+            if start is not None and start > cutoff:
+                # CloudTrail delivers a file after the period it covers, so nothing in a
+                # partition starting after the cutoff is old enough yet
+                with self.lock:
+                    self.skipped_partitions += 1
+                continue
+            walk.append(sub)
+        return self._track(contents), walk
+
+    def _list(self, prefix, delimiter, start_after=None):
+        kwargs = {'Bucket': self.bucket, 'Prefix': prefix}
+        if delimiter:
+            kwargs['Delimiter'] = delimiter
+        if start_after:
+            kwargs['StartAfter'] = start_after
+
+        contents = []
+        prefixes = []
+        for page in self.client.get_paginator('list_objects_v2').paginate(**kwargs):
+            with self.lock:
+                self.list_calls += 1
+            contents.extend(page.get('Contents', []))
+            prefixes.extend(p['Prefix'] for p in page.get('CommonPrefixes', []))
+        return contents, prefixes
+
+    # Remembers the keys listed below region prefixes; returns contents unchanged
+    def _track(self, contents):
+        if self.cursor is not None:
+            with self.lock:
+                for c in contents:
+                    region = self.regionOf(c['Key'])
+                    if region is not None:
+                        self.listed.setdefault(region, []).append(c['Key'])
+        return contents
+
+    # Returns the region prefix (.../CloudTrail/<region>/) a key is under, None if there is none
+    def regionOf(self, key):
+        segments = key.split(self.DELIMITER)
+        index = self._folderIndex(segments[:-1])
+        if index is None or index + 2 >= len(segments):
+            return None
+        return self.DELIMITER.join(segments[:index + 2]) + self.DELIMITER
+
+    def _isRegion(self, prefix):
+        segments = prefix.rstrip(self.DELIMITER).split(self.DELIMITER)
+        return self._folderIndex(segments) == len(segments) - 2
+
+    # Returns the position of the last CloudTrail (or CloudTrail-Digest, ...) folder, None if there is none
+    def _folderIndex(self, segments):
+        for i in range(len(segments) - 1, -1, -1):
+            if segments[i].startswith(Constants.AWS_CLOUDTRAIL_FOLDER):
+                return i
+        return None
+
+    # Returns the (year[, month[, day]]) a prefix is a date partition of, None if it isn't one
+    def _partitionDate(self, prefix):
+        segments = prefix.rstrip(self.DELIMITER).split(self.DELIMITER)
+        # the date follows the region, which follows the CloudTrail folder
+        index = self._folderIndex(segments)
+        if index is None:
+            return None
+        date = segments[index + 2:]
+        if 1 <= len(date) <= 3 and all(part.isdigit() for part in date):
+            return tuple(int(part) for part in date)
+        return None
+
+    # Returns the UTC start of the period a date partition covers, None if it isn't one
+    def _partitionStart(self, prefix):
+        date = self._partitionDate(prefix)
+        if date is None:
+            return None
+        try:
+            return datetime(date[0],
+                            date[1] if len(date) > 1 else 1,
+                            date[2] if len(date) > 2 else 1,
+                            tzinfo=timezone.utc)
+        except ValueError:
+            # not a real date after all, walk it like any other prefix
+            return None
+
+    def getFields(self):
+        return ['SweepListCalls=%d' % self.list_calls,
+                'SweepSkippedPartitions=%d' % self.skipped_partitions]
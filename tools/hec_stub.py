@@ -0,0 +1,130 @@
+"""
+Description: Minimal local stand-in for a Splunk HTTP Event Collector, to try CTGrazer's HEC
+handling without an indexer. It accepts posts to /services/collector/event, answers
+/services/collector/health, and with --ack hands out ackIds per channel and answers
+/services/collector/ack. Acks can be confirmed at once, after a delay, or never, and posts
+can be rejected, to exercise retries, ack timeouts and the spill.
+
+    python tools/hec_stub.py --port 8088 --ack --ack-mode never
+
+then point splunk_hec_endpoint at http://localhost:8088/services/collector/event.
+"""
+
+import argparse
+import gzip
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+EVENT_PATH = '/services/collector/event'
+ACK_PATH = '/services/collector/ack'
+HEALTH_PATH = '/services/collector/health'
+CHANNEL_HEADER = 'X-Splunk-Request-Channel'
+
+
+class HecStub:
+
+    def __init__(self, ack, ack_mode, ack_delay, reject_match, reject_status):
+        self.ack = ack
+        self.ack_mode = ack_mode
+        self.ack_delay = ack_delay
+        self.reject_match = reject_match.encode() if reject_match else None
+        self.reject_status = reject_status
+        self.ack_ids = itertools.count()
+        # channel -> {ackId: time posted}
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.posts = 0
+        self.events = 0
+        self.rejected = 0
+
+    def post(self, body, channel):
+        if self.reject_match is not None and self.reject_match in body:
+            with self.lock:
+                self.rejected += 1
+            return self.reject_status, {'text': 'Invalid data format', 'code': 6}
+        with self.lock:
+            self.posts += 1
+            self.events += body.count(b'"event"')
+            if not self.ack:
+                return 200, {'text': 'Success', 'code': 0}
+            if channel is None:
+                return 400, {'text': 'Data channel is missing', 'code': 10}
+            ack_id = next(self.ack_ids)
+            self.pending.setdefault(channel, {})[ack_id] = time.time()
+        return 200, {'text': 'Success', 'code': 0, 'ackId': ack_id}
+
+    def status(self, ack_ids, channel):
+        now = time.time()
+        acks = {}
+        with self.lock:
+            pending = self.pending.get(channel, {})
+            for ack_id in ack_ids:
+                posted = pending.get(ack_id)
+                acks[str(ack_id)] = posted is not None and self.ack_mode != 'never' and \
+                                    (self.ack_mode == 'confirm' or now - posted >= self.ack_delay)
+        return 200, {'acks': acks}
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    stub = None
+
+    def do_GET(self):
+        if self.path.startswith(HEALTH_PATH):
+            self._reply(200, {'text': 'HEC is healthy', 'code': 17})
+        else:
+            self._reply(404, {'text': 'Not found', 'code': 404})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        channel = self.headers.get(CHANNEL_HEADER)
+        path = self.path.split('?')[0]
+        if path == ACK_PATH:
+            self._reply(*self.stub.status(json.loads(body).get('acks', []), channel))
+        elif path.startswith(EVENT_PATH):
+            self._reply(*self.stub.post(body, channel))
+        else:
+            self._reply(404, {'text': 'Not found', 'code': 404})
+
+    def _reply(self, status, message):
+        data = json.dumps(message).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for a Splunk HEC endpoint')
+    parser.add_argument('--port', type=int, default=8088)
+    parser.add_argument('--ack', action='store_true', help='hand out ackIds, as with indexer acknowledgment on')
+    parser.add_argument('--ack-mode', choices=['confirm', 'delay', 'never'], default='confirm',
+                        help='confirm acks at once, after --ack-delay seconds, or never')
+    parser.add_argument('--ack-delay', type=float, default=2.0)
+    parser.add_argument('--reject-match', help='reject posts whose body contains this text')
+    parser.add_argument('--reject-status', type=int, default=400)
+    args = parser.parse_args()
+
+    Handler.stub = HecStub(args.ack, args.ack_mode, args.ack_delay, args.reject_match, args.reject_status)
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), Handler)
+    print('HEC stub listening on http://127.0.0.1:%d%s' % (args.port, EVENT_PATH))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    stub = Handler.stub
+    print('Posts=%d Events=%d Rejected=%d' % (stub.posts, stub.events, stub.rejected))
+
+
+if __name__ == '__main__':
+    main()